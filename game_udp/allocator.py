@@ -0,0 +1,56 @@
+"""
+Id Allocator for the Multiplayer Game Server
+By Jamal Bouajjaj, 2023
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import collections
+import typing
+
+
+class IdAllocator:
+    """
+    Hands out unique integers from `range(start, stop, step)` in O(1), and takes them back when released.
+
+    Never-used values come from a counter, and released ones go in a free list. By default never-used values are
+    given out first, so that a released id stays unused for as long as possible (a late packet about an old player
+    won't be mistaken for a new one). With `recycle_first`, released values are given out first instead, which keeps
+    the values low (i.e for colors, where the first ones are the nicest).
+    """
+    def __init__(self, start: int, stop: int, step: int = 1, recycle_first: bool = False):
+        self.stop = stop
+        self.step = step
+        self.recycle_first = recycle_first
+        self.next = start
+        self.free = collections.deque()
+        self.used = set()
+
+    def allocate(self) -> typing.Optional[int]:
+        """Returns a unique value, or None if they are all in use"""
+        if self.free and (self.recycle_first or self.next >= self.stop):
+            v = self.free.popleft()
+        elif self.next < self.stop:
+            v = self.next
+            self.next += self.step
+        else:
+            return None
+        self.used.add(v)
+        return v
+
+    def release(self, v: int):
+        """Gives a value back so it can be re-used"""
+        self.used.remove(v)
+        if self.recycle_first:
+            self.free.appendleft(v)
+        else:
+            self.free.append(v)
+
+    def __contains__(self, v: int) -> bool:
+        return v in self.used
+
+    def __len__(self):
+        return len(self.used)
@@ -0,0 +1,77 @@
+"""
+Snapshot Decoding Micro-Benchmark
+By Jamal Bouajjaj, 2023
+
+Times how long it takes the client to decode a snapshot's `(ID, x pos, y pos)` entries, with the old way of
+slicing the rest of the buffer off after each entry, with `decode_entries` going over a `memoryview`, and with a
+NumPy `frombuffer` view if NumPy is installed, i.e:
+    python bench_decode.py --players 10 100 1000
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import argparse
+import random
+import struct
+import timeit
+
+from protocol import decode_entries, entry_codec
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def make_snapshot(n_players: int) -> bytes:
+    """A snapshot's entries for `n_players` players at random positions"""
+    rng = random.Random(n_players)
+    return b''.join(entry_codec.pack(i, rng.randrange(0, 480), rng.randrange(0, 480)) for i in range(n_players))
+
+
+def decode_slicing(data: bytes) -> dict:
+    """How the client used to do it, which copies the rest of the buffer for every entry"""
+    positions = {}
+    for i in range(len(data) // 6):
+        id, posx, posy = struct.unpack("hhh", data[:6])
+        positions[id] = (posx, posy)
+        data = data[6:]
+    return positions
+
+
+def decode_view(data: bytes) -> dict:
+    positions = {}
+    decode_entries(memoryview(data), positions)
+    return positions
+
+
+def decode_numpy(data: bytes) -> dict:
+    a = np.frombuffer(data, dtype=np.int16).reshape(-1, 3)
+    return {p_id: (x, y) for p_id, x, y in a.tolist()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks decoding the client's snapshots")
+    parser.add_argument('--players', type=int, nargs='+', default=[10, 100, 1000], help="the player counts to try")
+    parser.add_argument('--repeat', type=int, default=5, help="how many times to run each, the best one is kept")
+    args = parser.parse_args()
+
+    decoders = {'slicing': decode_slicing, 'memoryview': decode_view}
+    if np is not None:
+        decoders['numpy'] = decode_numpy
+
+    print(f"{'players':>8}" + ''.join(f"{name:>14}" for name in decoders))
+    for n in args.players:
+        data = make_snapshot(n)
+        expected = decode_slicing(data)
+        row = f"{n:>8}"
+        for name, fn in decoders.items():
+            assert fn(data) == expected, f"{name} decoded the snapshot wrong"
+            # Aim for about the same total amount of work for every player count
+            number = max(10, 100000 // n)
+            best = min(timeit.repeat(lambda: fn(data), number=number, repeat=args.repeat)) / number
+            row += f"{best * 1e6:>12.1f}us"
+        print(row)
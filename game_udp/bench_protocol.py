@@ -0,0 +1,97 @@
+"""
+Wire Protocol Encode/Decode Benchmark
+By Jamal Bouajjaj, 2023
+
+Measures how many messages per second `protocol.py` encodes and decodes, for each way of using it: the message
+objects, the `pack`/`pack_into` classmethods and the codecs directly, next to the old way of joining `bytes`
+together with `struct.pack`, i.e:
+    python bench_protocol.py --players 100
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import argparse
+import struct
+import timeit
+
+import protocol
+
+
+def cases(n_players: int) -> dict:
+    """The things to time, by name. Each one gets checked to give the same result as the first of its group"""
+    # The pack_into ones write into the same buffer every time, and give a view of it instead of copying it out
+    buf = bytearray(65535)
+    view = memoryview(buf)
+    pos = protocol.Pos(120, 340)
+    pos_data = pos.encode()
+    body = b''.join(protocol.entry_codec.pack(i, i * 2, i * 3) for i in range(n_players))
+    snap = protocol.Snapshot(7, 123456, protocol.KEYFRAME, n_players, body)
+    snap_data = snap.encode()
+
+    def snapshot_concat():
+        return b'\xFF\x11' + struct.pack("=HIBH", 7, 123456, protocol.KEYFRAME, n_players) + body
+
+    def snapshot_pack():
+        # What the server does
+        return protocol.Snapshot.pack(7, 123456, protocol.KEYFRAME, n_players) + body
+
+    def snapshot_pack_append():
+        data = bytearray(protocol.Snapshot.pack(7, 123456, protocol.KEYFRAME, n_players))
+        data += body
+        return data
+
+    def snapshot_pack_into():
+        offset = protocol.Snapshot.pack_into(buf, 0, 7, 123456, protocol.KEYFRAME, n_players)
+        buf[offset:offset + len(body)] = body
+        return view[:offset + len(body)]
+
+    return {
+        'encode pos': {
+            'concat': lambda: b"\xFF\x01" + struct.pack("hh", 120, 340),
+            'object': lambda: protocol.Pos(120, 340).encode(),
+            'pack': lambda: protocol.Pos.pack(120, 340),
+            'pack_into': lambda: view[:protocol.Pos.pack_into(buf, 0, 120, 340)],
+        },
+        'decode pos': {
+            'slice': lambda: struct.unpack("hh", pos_data[2:]),
+            'object': lambda: (lambda m: (m.x, m.y))(protocol.decode(pos_data)),
+            'codec': lambda: protocol.Pos.codec.unpack_from(pos_data)[2:],
+        },
+        f'encode snapshot ({n_players})': {
+            'concat': snapshot_concat,
+            'object': lambda: snap.encode(),
+            'pack': snapshot_pack,
+            'pack+=': snapshot_pack_append,
+            'pack_into': snapshot_pack_into,
+        },
+        f'decode snapshot ({n_players})': {
+            'object': lambda: protocol.decode(snap_data).positions(),
+            'codec': lambda: (lambda positions: (protocol.decode_entries(
+                memoryview(snap_data)[protocol.Snapshot.codec.size:], positions), positions)[1])({}),
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks encoding and decoding the game's messages")
+    parser.add_argument('--players', type=int, default=100, help="how many players are in the snapshots")
+    parser.add_argument('--number', type=int, default=20000, help="how many messages each run does")
+    parser.add_argument('--repeat', type=int, default=5, help="how many runs, the best one is kept")
+    args = parser.parse_args()
+
+    for group, fns in cases(args.players).items():
+        print(group)
+        expected = None
+        for name, fn in fns.items():
+            result = fn()
+            if isinstance(result, (bytearray, memoryview)):
+                result = bytes(result)
+            if expected is None:
+                expected = result
+            assert result == expected, f"{group}: {name} gave {result!r} instead of {expected!r}"
+            number = max(10, args.number // max(1, args.players // 10)) if 'snapshot' in group else args.number
+            best = min(timeit.repeat(fn, number=number, repeat=args.repeat)) / number
+            print(f"  {name:>10}: {1 / best:>12,.0f} msg/s  ({best * 1e6:.2f}us)")
@@ -0,0 +1,235 @@
+"""
+Headless Bot Swarm Load Generator
+By Jamal Bouajjaj, 2023
+
+Spawns many simulated players in one process, each one a `ClientHandler` without a window, that walk around randomly
+and send their position to the server. It measures how the server keeps up, and writes a JSON report, i.e:
+    python bots.py --server 127.0.0.1:8080 --bots 500 --duration 30 --report report.json
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import argparse
+import json
+import logging
+import random
+import selectors
+import socket
+import statistics
+import sys
+import time
+import typing
+
+from client import ClientHandler
+from metrics import Histogram
+from ticker import TickScheduler
+
+
+class Bot(ClientHandler):
+    """
+    A simulated player. It speaks the protocol through `ClientHandler`, but its messages are read by the swarm
+    instead of a thread per bot, and it only keeps count of what it receives instead of queueing it for a game loop.
+    """
+    speed = 300             # pixels per second, same as a real player
+    area = (480, 480)
+
+    def __init__(self, server_addr: tuple, rng: random.Random, room: typing.Optional[int] = None):
+        self.room = room
+        super().__init__()
+        self.server_addr = server_addr
+        self.rng = rng
+        self.x = rng.uniform(0, self.area[0])
+        self.y = rng.uniform(0, self.area[1])
+        self.target = self.new_target()
+
+        self.join_latency = None        # type: typing.Optional[float]
+        self.snapshots = 0
+        self.seq_gaps = 0
+        self.bytes_in = 0
+        self.packets_in = 0
+        self.bytes_out = 0
+        self.packets_out = 0
+        self.last_snapshot_at = None    # type: typing.Optional[float]
+        self.intervals = []             # type: typing.List[float]
+
+    def new_target(self) -> tuple:
+        return self.rng.uniform(0, self.area[0]), self.rng.uniform(0, self.area[1])
+
+    def join(self) -> bool:
+        """Joins the server, timing how long it took to be accepted"""
+        start = time.perf_counter()
+        if self.connect(start_reader=False) is None:
+            return False
+        self.join_latency = time.perf_counter() - start
+        return True
+
+    def walk(self, dt: float):
+        """Moves towards the current target, picking a new one once there, and sends the new position"""
+        dx, dy = self.target[0] - self.x, self.target[1] - self.y
+        dist = (dx * dx + dy * dy) ** 0.5
+        step = self.speed * dt
+        if dist <= step:
+            self.x, self.y = self.target
+            self.target = self.new_target()
+        else:
+            self.x += dx / dist * step
+            self.y += dy / dist * step
+        self.send_xy(self.x, self.y)
+
+    def send(self, data: bytes):
+        super().send(data)
+        self.packets_out += 1
+        self.bytes_out += len(self.room_prefix) + len(data)
+
+    def handle_packet(self, r):
+        self.packets_in += 1
+        self.bytes_in += len(r)
+        super().handle_packet(r)
+
+    def apply_snapshot(self, seq: int, server_ms: int, flags: int, chunks: typing.List[bytes]):
+        if self.last_seq is not None and not self.is_old(seq):
+            self.seq_gaps += ((seq - self.last_seq) & 0xFFFF) - 1
+        super().apply_snapshot(seq, server_ms, flags, chunks)
+
+    def on_snapshot(self, seq: int):
+        now = time.perf_counter()
+        if self.last_snapshot_at is not None:
+            self.intervals.append(now - self.last_snapshot_at)
+        self.last_snapshot_at = now
+        self.snapshots += 1
+
+    def on_positions(self, server_time: float, positions: typing.Dict[int, tuple], keyframe: bool = False):
+        pass
+
+    def on_new_enemy(self, id: int, color: int):
+        pass
+
+    def on_del_enemy(self, id: int):
+        pass
+
+
+class Swarm:
+    """
+    Runs all the bots from a single thread: a selector reads the bots' sockets, while a `TickScheduler` has them
+    all walk and send their position `send_rate` times a second.
+    """
+    def __init__(self, server_addr: tuple, n_bots: int, send_rate: float = 60, seed: typing.Optional[int] = None,
+                 rooms: int = 0):
+        self.log = logging.getLogger('swarm')
+        self.server_addr = server_addr
+        self.n_bots = n_bots
+        self.send_rate = send_rate
+        self.rooms = rooms      # spread the bots over this many rooms (see `rooms.py`), 0 for a plain server
+        self.rng = random.Random(seed)
+        self.bots = []          # type: typing.List[Bot]
+        self.failed_joins = 0
+        self.sel = selectors.DefaultSelector()
+        self.ticker = TickScheduler(send_rate)
+
+    def join_all(self):
+        for i in range(self.n_bots):
+            bot = Bot(self.server_addr, self.rng, i % self.rooms if self.rooms else None)
+            if not bot.join():
+                self.failed_joins += 1
+                bot.conn.close()
+                continue
+            self.bots.append(bot)
+            self.sel.register(bot.conn, selectors.EVENT_READ, bot)
+        self.log.info(f"{len(self.bots)} bots joined, {self.failed_joins} failed")
+
+    def walk_all(self):
+        for bot in self.bots:
+            bot.walk(self.ticker.period)
+
+    def run(self, duration: float) -> float:
+        """Runs the bots for `duration` seconds, returning how long it actually ran for"""
+        buf = bytearray(65535)
+        view = memoryview(buf)
+        start = time.perf_counter()
+        end = start + duration
+        while time.perf_counter() < end:
+            for key, _ in self.sel.select(min(self.ticker.delay(), max(0.0, end - time.perf_counter()))):
+                try:
+                    n = key.fileobj.recv_into(buf)
+                except (socket.timeout, ConnectionError):
+                    continue
+                key.data.handle_packet(view[:n])
+            for _ in range(self.ticker.due()):
+                self.ticker.tick(self.walk_all)
+        return time.perf_counter() - start
+
+    def close(self):
+        for bot in self.bots:
+            self.sel.unregister(bot.conn)
+            bot.close()
+        self.sel.close()
+
+    def report(self, elapsed: float) -> dict:
+        joins = Histogram()
+        arrivals = Histogram()
+        intervals = []
+        for bot in self.bots:
+            joins.record(bot.join_latency)
+            for i in bot.intervals:
+                arrivals.record(i)
+            intervals.extend(bot.intervals)
+        snapshots = sum(b.snapshots for b in self.bots)
+        gaps = sum(b.seq_gaps for b in self.bots)
+        return {
+            'bots': len(self.bots),
+            'rooms': self.rooms,
+            'failed_joins': self.failed_joins,
+            'duration': elapsed,
+            'send_rate': self.send_rate,
+            'join_latency': joins.as_dict(),
+            'snapshot_interval': arrivals.as_dict(),
+            'snapshot_jitter': statistics.pstdev(intervals) if intervals else 0.0,
+            'snapshots': snapshots,
+            # An upper bound of the snapshots that got lost, as the server skips some when it slows down a bot
+            # because of its link
+            'snapshot_seq_gaps': gaps,
+            'snapshot_loss': gaps / (gaps + snapshots) if gaps + snapshots else 0.0,
+            'server_packets_per_sec': sum(b.packets_in for b in self.bots) / elapsed,
+            'server_bytes_per_sec': sum(b.bytes_in for b in self.bots) / elapsed,
+            'bot_packets_per_sec': sum(b.packets_out for b in self.bots) / elapsed,
+            'bot_bytes_per_sec': sum(b.bytes_out for b in self.bots) / elapsed,
+            'bot_ticks': self.ticker.stats.as_dict(),
+        }
+
+
+def parse_addr(s: str) -> tuple:
+    host, port = s.rsplit(':', 1)
+    return host, int(port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless bot swarm for load testing the game server")
+    parser.add_argument('--server', type=parse_addr, default=ClientHandler.server_addr, help="the server's host:port")
+    parser.add_argument('--bots', type=int, default=100, help="how many bots to spawn")
+    parser.add_argument('--send-rate', type=float, default=60, help="position updates per second, per bot")
+    parser.add_argument('--duration', type=float, default=10, help="how long to run for, in seconds")
+    parser.add_argument('--rooms', type=int, default=0,
+                        help="spread the bots over this many rooms, for a server with rooms (`rooms.py`)")
+    parser.add_argument('--seed', type=int, help="seed for the bots' random walks")
+    parser.add_argument('--report', help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger('client').setLevel(logging.WARNING)
+    swarm = Swarm(args.server, args.bots, args.send_rate, args.seed, args.rooms)
+    swarm.join_all()
+    try:
+        elapsed = swarm.run(args.duration)
+    finally:
+        swarm.close()
+
+    report = json.dumps(swarm.report(elapsed), indent=2)
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
+    sys.exit(1 if swarm.failed_joins else 0)
@@ -0,0 +1,87 @@
+"""
+Packet Capture for the Multiplayer Game Server
+By Jamal Bouajjaj, 2023
+
+Records every datagram the server receives into an append-only binary file, so that a session can be replayed
+later with `replay.py`.
+
+The file starts with the `magic`, followed by one record per datagram: a `record` header of
+`(time, IPv4 address, port, length)` and then the datagram itself. The time is `time.time()` as a double, so
+captures appended to over several runs stay in order. A record cut short at the end (i.e the server got killed
+while writing it) is ignored when reading.
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import mmap
+import os
+import socket
+import struct
+import time
+import typing
+
+magic = b'GUDPCAP\x01'
+record = struct.Struct("=d4sHH")        # time, IPv4 address, port, length
+
+
+class CaptureWriter:
+    """Appends the datagrams to a capture file, creating it if needed"""
+    def __init__(self, path: str, clock: typing.Callable[[], float] = time.time):
+        self.path = path
+        self.clock = clock
+        self.count = 0
+        self.f = open(path, 'ab')
+        if self.f.tell() == 0:
+            self.f.write(magic)
+        else:
+            with open(path, 'rb') as f:
+                if f.read(len(magic)) != magic:
+                    self.f.close()
+                    raise ValueError(f"{path} is not a capture file")
+
+    def write(self, data: bytes, addr: tuple):
+        self.f.write(record.pack(self.clock(), socket.inet_aton(addr[0]), addr[1], len(data)))
+        self.f.write(data)
+        self.count += 1
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class CaptureReader:
+    """
+    Reads a capture file through `mmap`, so the datagrams are given as `memoryview`s into the file instead of being
+    copied. They are only valid until `close`
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < len(magic):
+                raise ValueError(f"{path} is not a capture file")
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(magic)] != magic:
+            self.mm.close()
+            raise ValueError(f"{path} is not a capture file")
+        self.view = memoryview(self.mm)
+
+    def __iter__(self) -> typing.Iterator[typing.Tuple[float, tuple, memoryview]]:
+        """Yields (time, (ip, port), datagram) for every record"""
+        offset = len(magic)
+        end = len(self.view)
+        while offset + record.size <= end:
+            t, ip, port, length = record.unpack_from(self.view, offset)
+            offset += record.size
+            if offset + length > end:
+                break
+            yield t, (socket.inet_ntoa(ip), port), self.view[offset:offset + length]
+            offset += length
+
+    def close(self):
+        self.view.release()
+        self.mm.close()
@@ -10,36 +10,184 @@ You should have received a copy of the GNU General Public License along with thi
 """
 import typing
 import logging
-import pygame
 import socket
 import threading
 import queue
 import time
-import struct
 import sys
 import enum
-from tkinter import simpledialog
-from tkinter import messagebox
+import colorsys
+import argparse
+import collections
+import protocol
+from protocol import colors, decode_entries
 
 # Change below depending on the IP address of the server
 SERVER_IP = ("172.19.50.243", 8080)
 
-# note: this must be the same as the server
-colors = ["red", "green", "blue", "cyan", "orange", "white", "aqua", "blueviolet", "darkred", "fuchsia"]
+
+def player_color(color_idx: int):
+    """
+    Gets the color to draw a player with. Once the server runs out of `colors`, it gives out indexes past it,
+    for which a color is made up by spreading the hue with the golden ratio
+    """
+    if color_idx < len(colors):
+        return colors[color_idx]
+    r, g, b = colorsys.hsv_to_rgb((color_idx * 0.618033988749895) % 1, 0.8, 1)
+    return int(r * 255), int(g * 255), int(b * 255)
 
 
 class ServerGameComm(enum.Enum):
     new_enemy = enum.auto()
-    update_pos = enum.auto()
     del_enemy = enum.auto()
 
 
+class LatestState:
+    """
+    The latest known position of each player, shared between the network thread and the game loop.
+
+    The network thread writes whole snapshots into the back buffer, overwriting whatever the game loop didn't pick up
+    yet, as only the latest position matters. Once per frame, the game loop swaps the buffers and gets all the
+    positions that changed since the last frame. The lock is only held for a snapshot's update or a swap, instead of
+    for every position like a queue would.
+
+    Each position is kept with the server time of the snapshot it came from, for `Interpolator`.
+
+    As a keyframe has every player the server sends us, it also tells which players we can see at all. With an area
+    of interest on the server, the ones that aren't in it went out of our range.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.back = {}          # type: typing.Dict[int, tuple]
+        self.front = {}         # type: typing.Dict[int, tuple]
+        self.latest = None      # type: typing.Optional[float]
+        self.visible = None     # type: typing.Optional[typing.Set[int]]
+
+    def update(self, server_time: float, positions: typing.Dict[int, tuple], keyframe: bool = False):
+        """Writes the new positions, by player id, from a snapshot taken at `server_time`"""
+        with self.lock:
+            if keyframe:
+                # Anything from before it that the game loop didn't pick up yet is for players we don't see anymore
+                self.back.clear()
+                self.visible = set(positions)
+            elif self.visible is not None:
+                self.visible.update(positions)
+            for p_id, pos in positions.items():
+                self.back[p_id] = (server_time, pos)
+            self.latest = server_time
+
+    def swap(self) -> typing.Tuple[typing.Optional[float], typing.Dict[int, tuple], typing.Optional[typing.Set[int]]]:
+        """
+        Gets the server time of the latest snapshot, the (server time, position) written since the last swap, and
+        the players that are still visible if a keyframe came in since then (None otherwise).
+        The returned dictionary is re-used, so it's only valid until the next call
+        """
+        with self.lock:
+            self.front.clear()
+            self.front, self.back = self.back, self.front
+            visible, self.visible = self.visible, None
+            return self.latest, self.front, visible
+
+
+class ServerClock:
+    """
+    Keeps track of the server's clock from the timestamps in the snapshots.
+
+    The timestamps are in milliseconds and wrap around, so they get unwrapped into seconds. The offset to our clock
+    is taken from the snapshot that arrived the quickest out of the last `window` ones, as that's the one that was
+    delayed the least by the network.
+    """
+    def __init__(self, window: int = 64, clock: typing.Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self.offsets = collections.deque(maxlen=window)
+        self.last_ms = None     # type: typing.Optional[int]
+        self.last_time = 0.0
+
+    def observe(self, server_ms: int) -> float:
+        """Takes in a snapshot's timestamp as it arrives, returning it in seconds"""
+        if self.last_ms is None:
+            self.last_time = server_ms / 1000
+        else:
+            delta = (server_ms - self.last_ms) & 0xFFFFFFFF
+            if delta >= 0x80000000:
+                # From before the last one, it arrived out of order
+                delta -= 0x100000000
+            self.last_time += delta / 1000
+        self.last_ms = server_ms
+        self.offsets.append(self.clock() - self.last_time)
+        return self.last_time
+
+    def now(self) -> typing.Optional[float]:
+        """Our best guess of what the server's clock is at right now, or None before the first snapshot"""
+        if not self.offsets:
+            return None
+        return self.clock() - min(list(self.offsets))
+
+
+class Interpolator:
+    """
+    Smooths out the other players' movements, by drawing them a bit in the past (`delay` seconds) and
+    interpolating between the snapshots around that time. If the snapshots stop coming in, the players keep going
+    with their last velocity for at most `max_extrapolate` seconds past the last one.
+
+    In delta snapshots, a player not being in it means they didn't move, which `advance` takes care of.
+    """
+    def __init__(self, delay: float = 0.1, max_extrapolate: float = 0.25, history: int = 16):
+        self.delay = delay
+        self.max_extrapolate = max_extrapolate
+        self.history_len = history
+        self.history = {}       # type: typing.Dict[int, typing.Deque[tuple]]
+
+    def push(self, p_id: int, t: float, pos: tuple):
+        """Adds a position of a player at server time `t`"""
+        h = self.history.get(p_id)
+        if h is None:
+            h = self.history[p_id] = collections.deque(maxlen=self.history_len)
+        elif h and t <= h[-1][0]:
+            return
+        h.append((t, pos[0], pos[1]))
+
+    def advance(self, t: float):
+        """Marks that as of the snapshot at server time `t`, the players without a newer position didn't move"""
+        for h in self.history.values():
+            if h[-1][0] < t:
+                h.append((t, h[-1][1], h[-1][2]))
+
+    def remove(self, p_id: int):
+        self.history.pop(p_id, None)
+
+    def sample(self, p_id: int, server_now: float) -> typing.Optional[tuple]:
+        """Gets where to draw a player, given the current server time"""
+        h = self.history.get(p_id)
+        if not h:
+            return None
+        t = server_now - self.delay
+        if t <= h[0][0]:
+            return h[0][1], h[0][2]
+        t1, x1, y1 = h[-1]
+        if t >= t1:
+            if len(h) < 2:
+                return x1, y1
+            t0, x0, y0 = h[-2]
+            ahead = min(t - t1, self.max_extrapolate)
+            return x1 + (x1 - x0) / (t1 - t0) * ahead, y1 + (y1 - y0) / (t1 - t0) * ahead
+        # Walk back to the two samples around t, it's usually the last couple
+        for i in range(len(h) - 1, 0, -1):
+            t0, x0, y0 = h[i - 1]
+            if t0 <= t:
+                t1, x1, y1 = h[i]
+                a = (t - t0) / (t1 - t0)
+                return x0 + (x1 - x0) * a, y0 + (y1 - y0) * a
+        return h[0][1], h[0][2]
+
+
 class ClientHandler:
     """
     A client UDP class for handling connecting to the server, send it
     the player position, and receiving updated data from the server
     """
     server_addr = SERVER_IP
+    room = None             # the room to join on a server with rooms (see `rooms.py`), None for a plain server
 
     def __init__(self):
         self.log = logging.getLogger('client')
@@ -49,18 +197,37 @@ class ClientHandler:
         self.exit = False
 
         self.id = None
+        self.stopped = threading.Event()    # set once the server shuts down
+        self.last_seq = None        # sequence of the newest snapshot applied
+        self.fragments = {}         # type: typing.Dict[int, typing.List[typing.Optional[bytes]]]
+
+        self.q = queue.Queue()          # players joining and leaving, in order
+        self.positions = LatestState()  # the players' positions
+        self.server_clock = ServerClock()
+        self.room_prefix = b'' if self.room is None else protocol.room_header.pack(protocol.ROOM, self.room)
+
+    def send(self, data: bytes):
+        """Sends a message to the server, in our room if we are in one"""
+        self.conn.sendto(self.room_prefix + data if self.room_prefix else data, self.server_addr)
 
-        self.q = queue.Queue()
+    def unwrap(self, r):
+        """Strips the room prefix from a message from the server, or returns None if it's not for our room"""
+        room, r = protocol.unwrap_room(r)
+        return r if room == self.room else None
 
-    def connect(self) -> typing.Union[None, int]:
+    def connect(self, start_reader: bool = True) -> typing.Union[None, int]:
         """
         Connect to the server
 
+        Args:
+            start_reader: start the thread that reads the server's messages. If not, `handle_packet` has to be called
+                with them instead
+
         Returns:
             None if unable to connect to the server, or an ID that the server gave back
 
         """
-        self.conn.sendto(b"\xFF\xA0", self.server_addr)
+        self.send(protocol.Join.pack())
         while 1:
             try:
                 r = self.conn.recv(1024)
@@ -69,47 +236,129 @@ class ClientHandler:
             else:
                 break
         self.log.debug(f"Received {r} for connect")
-        if not r.startswith(b'\xFF\xA1'):
+        r = self.unwrap(r)
+        if r is None or len(r) < protocol.JoinAccept.codec.size or r[:2] != bytes([protocol.ESCAPE, protocol.JOIN_ACCEPT]):
             return None
-        self.id, color = struct.unpack("hh", r[2:])
-        self.t.start()
+        _, _, self.id, color = protocol.JoinAccept.codec.unpack_from(r)
+        if start_reader:
+            self.t.start()
         return color
 
     def run_read(self):
-        """
-        A thread loop that is used to listen to the server and process all messages from it
-
-        TODO: have `running` be given as an argument
-        """
-        global running
+        """A thread loop that is used to listen to the server and process all messages from it"""
+        # Every message is received into the same buffer, and handled through a view of it instead of a new bytes
+        buf = bytearray(65535)
+        view = memoryview(buf)
         while not self.exit:
             try:
-                r = self.conn.recv(1024)
+                n = self.conn.recv_into(buf)
             except socket.timeout:
                 continue
-            self.log.debug(f"Received {r} for data")
-            if r.startswith(b'\xFF\x10'):
-                p_n = int(r[2])
-                data = r[3:]
-                for i in range(p_n):
-                    id, posx, posy = struct.unpack("hhh", data[:6])
-                    self.q.put((ServerGameComm.update_pos, id, posx, posy))
-                    data = data[6:]
-            elif r.startswith(b'\xFF\x20'):
-                data = r[2:]
-                other_id, other_color = struct.unpack("hh", data)
-                self.q.put([ServerGameComm.new_enemy, other_id, other_color])
-            elif r.startswith(b'\xFF\x21'):
-                data = r[2:]
-                other_id = struct.unpack("h", data)[0]
-                self.q.put([ServerGameComm.del_enemy, other_id])
-            elif r == b'\xFF\xE0':
-                running.set()
+            self.handle_packet(view[:n])
+
+    def handle_packet(self, r):
+        """
+        Processes one message from the server. `r` can be a `memoryview` that gets re-used once this returns, so
+        anything kept for later has to be copied
+        """
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Received %s for data", bytes(r))
+        if self.room is not None:
+            r = self.unwrap(r)
+            if r is None:
+                return
+        if len(r) < 2 or r[0] != protocol.ESCAPE:
+            return
+        command = r[1]
+        msg = protocol.message_types.get(command)
+        if msg is None or len(r) < msg.codec.size:
+            # Not something we know, or cut short
+            return
+        if command == protocol.WORLD:
+            start = protocol.World.codec.size
+            p_n = r[2]
+            if len(r) < protocol.World.size(p_n):
+                return
+            positions = {}
+            decode_entries(r[start:start + protocol.entry_codec.size * p_n], positions)
+            # These don't have a timestamp, so use when they arrived
+            self.on_positions(self.server_clock.observe(int(time.monotonic() * 1000) & 0xFFFFFFFF), positions)
+        elif command == protocol.SNAPSHOT:
+            _, _, seq, server_ms, flags, p_n = protocol.Snapshot.codec.unpack_from(r)
+            if len(r) < protocol.Snapshot.size(p_n):
+                return
+            start = protocol.Snapshot.codec.size
+            self.apply_snapshot(seq, server_ms, flags, [r[start:start + protocol.entry_codec.size * p_n]])
+        elif command == protocol.SNAPSHOT_FRAGMENT:
+            _, _, seq, server_ms, flags, frag_idx, frag_count, p_n = protocol.SnapshotFragment.codec.unpack_from(r)
+            if self.is_old(seq) or frag_idx >= frag_count or len(r) < protocol.SnapshotFragment.size(p_n):
+                return
+            start = protocol.SnapshotFragment.codec.size
+            frags = self.fragments.setdefault(seq, [None] * frag_count)
+            if len(frags) != frag_count:
+                # Doesn't go with the other fragments of that snapshot
+                return
+            frags[frag_idx] = bytes(r[start:start + protocol.entry_codec.size * p_n])
+            if None not in frags:
+                self.fragments.pop(seq)
+                self.apply_snapshot(seq, server_ms, flags, frags)
+        elif command == protocol.PLAYER_JOINED:
+            _, _, other_id, other_color = protocol.PlayerJoined.codec.unpack_from(r)
+            self.on_new_enemy(other_id, other_color)
+        elif command == protocol.PLAYER_LEFT:
+            other_id = protocol.PlayerLeft.codec.unpack_from(r)[2]
+            self.on_del_enemy(other_id)
+        elif command == protocol.PING:
+            self.send(protocol.Pong.pack(protocol.Ping.codec.unpack_from(r)[2]))
+        elif command == protocol.SHUTDOWN:
+            self.stopped.set()
+
+    # The following are called as the server's messages come in, by default they are passed to the game loop
+    # through `positions` and `q`
+    def on_positions(self, server_time: float, positions: typing.Dict[int, tuple], keyframe: bool = False):
+        """
+        Called with the new positions of a snapshot, by player id, and the server time it was taken at. If it's a
+        keyframe, these are all the players we can see
+        """
+        self.positions.update(server_time, positions, keyframe)
+
+    def on_new_enemy(self, id: int, color: int):
+        self.q.put([ServerGameComm.new_enemy, id, color])
+
+    def on_del_enemy(self, id: int):
+        self.q.put([ServerGameComm.del_enemy, id])
+
+    def on_snapshot(self, seq: int):
+        """Called once a whole snapshot was applied"""
+        pass
+
+    def is_old(self, seq: int) -> bool:
+        """If a snapshot sequence is older than the last one applied, i.e it arrived out of order"""
+        return self.last_seq is not None and ((seq - self.last_seq) & 0xFFFF) >= 0x8000
+
+    def apply_snapshot(self, seq: int, server_ms: int, flags: int, chunks: typing.List[bytes]):
+        """Applies a complete snapshot, given as the player data of each of its fragments, and acknowledges it"""
+        # Drop snapshots that arrived out of order, anything newer already has their data
+        if self.is_old(seq):
+            return
+        positions = {}
+        for data in chunks:
+            decode_entries(data, positions)
+        self.on_positions(self.server_clock.observe(server_ms), positions, bool(flags & protocol.KEYFRAME))
+        self.last_seq = seq
+        # Fragments of snapshots older than this one will never be needed
+        for s in [s for s in self.fragments if self.is_old(s)]:
+            self.fragments.pop(s)
+        self.send(protocol.Ack.pack(seq))
+        self.on_snapshot(seq)
 
     def send_pos(self, p):
         """Sends the current player position to the server"""
-        to_send = b"\xFF\x01"+struct.pack("hh", int(p.x), int(p.y))
-        self.conn.sendto(to_send, self.server_addr)
+        self.send_xy(p.x, p.y)
+
+    def send_xy(self, x: float, y: float):
+        """Sends a player position to the server"""
+        self.send(protocol.Pos.pack(int(x), int(y)))
 
     def __del__(self):
         """Calls on the __del__ function to ensure the socket will always close"""
@@ -118,15 +367,72 @@ class ClientHandler:
     def close(self):
         """Closes the socket, and indicates end-of-connection to the server"""
         self.log.info("Closing socket")
-        self.conn.sendto(b"\xFF\xF0", self.server_addr)
+        self.send(protocol.Leave.pack())
         self.exit = True
-        self.t.join()
+        if self.t.is_alive():
+            self.t.join()
         self.conn.close()
 
 
+class PositionSender:
+    """
+    Decides when the player's position gets sent to the server.
+
+    The game loop gives it the position every frame with `update`, and calls `poll`. At most one position update is
+    sent every `1 / rate` seconds, and only if the position changed since the last one sent. If it didn't change for
+    `keep_alive` seconds, it's sent anyways so the server knows we are still here.
+    """
+    def __init__(self, client: ClientHandler, rate: float = 30, keep_alive: float = 1.0,
+                 clock: typing.Callable[[], float] = time.monotonic):
+        self.client = client
+        self.period = 1 / rate
+        self.keep_alive = keep_alive
+        self.clock = clock
+        self.pos = None             # type: typing.Optional[tuple]
+        self.last_sent = None       # type: typing.Optional[tuple]
+        self.last_sent_at = 0.0
+        self.next_send = 0.0
+
+    def update(self, x: float, y: float):
+        """Sets the current position of the player"""
+        self.pos = (int(x), int(y))
+
+    def poll(self) -> bool:
+        """Sends the position if it's time to, returns if something was sent"""
+        now = self.clock()
+        if self.pos is None or now < self.next_send:
+            return False
+        # Stay on the rate's grid, unless we fell more than a period behind (i.e a slow frame)
+        self.next_send = max(self.next_send + self.period, now)
+        if self.pos == self.last_sent and now - self.last_sent_at < self.keep_alive:
+            return False
+        self.client.send_xy(*self.pos)
+        self.last_sent = self.pos
+        self.last_sent_at = now
+        return True
+
+
 if __name__ == "__main__":
+    import pygame
+    from tkinter import messagebox
+    from render import renderers
+
+    parser = argparse.ArgumentParser(description="Multiplayer game client example")
+    parser.add_argument('--send-rate', type=float, default=30, help="most position updates sent per second")
+    parser.add_argument('--interp-delay', type=float, default=0.1,
+                        help="how far in the past, in seconds, the other players are drawn to smooth them out")
+    parser.add_argument('--extrapolate', type=float, default=0.25,
+                        help="how long, in seconds, to keep the other players moving once the snapshots stop")
+    parser.add_argument('--renderer', choices=['full', 'dirty'], default='full',
+                        help="`dirty` only redraws the players that moved, and nothing at all when no one moved")
+    parser.add_argument('--room', type=int, help="the room to join, for a server with rooms (`rooms.py`)")
+    parser.add_argument('--keep-alive', type=float, default=1.0,
+                        help="seconds after which the position is re-sent even if it didn't change")
+    args = parser.parse_args()
+
     logging.basicConfig(level=logging.INFO)
 
+    ClientHandler.room = args.room
     srv = ClientHandler()
     # todo: implement sending name to server
     # name = simpledialog.askstring("Name", "What is your name to be displayed?")
@@ -140,13 +446,16 @@ if __name__ == "__main__":
     screen = pygame.display.set_mode((480, 480))
     pygame.display.set_caption("Client UDP Example")
     clock = pygame.time.Clock()
-    running = threading.Event()
+    running = srv.stopped
     dt = 0
 
     player_pos = pygame.Vector2(screen.get_width() / 2, screen.get_height() / 2)
     enemy_pos = {}
+    interp = Interpolator(args.interp_delay, args.extrapolate)
+    renderer = renderers[args.renderer](screen)
 
-    srv.send_pos(player_pos)
+    sender = PositionSender(srv, args.send_rate, args.keep_alive)
+    sender.update(player_pos.x, player_pos.y)
 
     while not running.is_set():
         # poll for events
@@ -154,45 +463,58 @@ if __name__ == "__main__":
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 running.set()
-
-        # fill the screen with a color to wipe away anything from last frame
-        screen.fill("black")
+            elif event.type == pygame.VIDEOEXPOSE:
+                # The window was covered, so what's on it is gone
+                renderer.invalidate()
 
         keys = pygame.key.get_pressed()
         if keys[pygame.K_w]:
             player_pos.y -= 300 * dt
-            srv.send_pos(player_pos)
         if keys[pygame.K_s]:
             player_pos.y += 300 * dt
-            srv.send_pos(player_pos)
         if keys[pygame.K_a]:
             player_pos.x -= 300 * dt
-            srv.send_pos(player_pos)
         if keys[pygame.K_d]:
             player_pos.x += 300 * dt
-            srv.send_pos(player_pos)
+        # All the keys' moves of this frame end up in at most one update, sent at the network rate
+        sender.update(player_pos.x, player_pos.y)
+        sender.poll()
 
         # A 'communication' between the game loop and the server thread
+        # First the players that joined or left, in order
         while not srv.q.empty():
             r = srv.q.get()
             if r[0] == ServerGameComm.new_enemy:
-                enemy_pos[r[1]] = {'pos': pygame.Vector2(screen.get_width() / 2, screen.get_height() / 2), 'color': colors[r[2]]}
-            elif r[0] == ServerGameComm.update_pos:
-                if r[1] != srv.id:
-                    enemy_pos[r[1]]['pos'].x = r[2]
-                    enemy_pos[r[1]]['pos'].y = r[3]
+                enemy_pos[r[1]] = {'pos': pygame.Vector2(screen.get_width() / 2, screen.get_height() / 2), 'color': player_color(r[2])}
             elif r[0] == ServerGameComm.del_enemy:
-                enemy_pos.pop(r[1])
+                enemy_pos.pop(r[1], None)
+                interp.remove(r[1])
             srv.q.task_done()
-
-        # Draw the enemies
-        for e in enemy_pos:
-            pygame.draw.circle(screen, enemy_pos[e]['color'], enemy_pos[e]['pos'], 30)
-        # Draw the player
-        pygame.draw.circle(screen, colors[p_color], player_pos, 30)
-
-        # flip() the display to put your work on screen
-        pygame.display.flip()
+        # Then the latest position of everyone that moved since the last frame
+        latest, moved, visible = srv.positions.swap()
+        if visible is not None:
+            # The ones a keyframe didn't have are out of our range, forget them until they come back
+            for e_id in enemy_pos:
+                if e_id not in visible:
+                    interp.remove(e_id)
+        for e_id, (t, pos) in moved.items():
+            # Keep the ones we don't know about yet as well, their join might just be behind their snapshot
+            if e_id != srv.id:
+                interp.push(e_id, t, pos)
+        if latest is not None:
+            interp.advance(latest)
+        # Draw the enemies, then the player on top of them. The ones we have no position for (yet, or anymore as
+        # they are out of our range) aren't drawn at all
+        circles = {}
+        server_now = srv.server_clock.now()
+        if server_now is not None:
+            for e_id in enemy_pos:
+                pos = interp.sample(e_id, server_now)
+                if pos is not None:
+                    enemy_pos[e_id]['pos'].update(pos)
+                    circles[e_id] = (enemy_pos[e_id]['color'], enemy_pos[e_id]['pos'])
+        circles['player'] = (player_color(p_color), player_pos)
+        renderer.draw(circles)
 
         # limits FPS to 60
         # dt is delta time in seconds since last frame, used for framerate-
@@ -0,0 +1,123 @@
+"""
+Congestion Control for the Multiplayer Game Server
+By Jamal Bouajjaj, 2023
+
+The server pings each client every so often (`0x30`, answered with `0x31`), which gives it the round trip time
+and the loss of the path to that client. From those, `LinkState` decides how many snapshots a second the client
+gets, and how big their packets can be, the same way TCP does (AIMD):
+- every ping that comes back in time adds a bit to the rate and the packet size
+- a lost ping, or one that took much longer than the fastest one (the network is queueing them up), halves them,
+  at most once per round trip, and never below the floors
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import typing
+
+
+class LinkState:
+    """
+    The network path to one client, and how much the server sends it.
+
+    `rate` is in snapshots per second, between `min_rate` and `max_rate` (the tick rate), and `mtu` is the biggest
+    snapshot packet in bytes, between `min_mtu` and `max_mtu`. All times are in seconds.
+    """
+    rate_step = 2.0             # snapshots per second added for every ping that came back fine
+    mtu_step = 64               # bytes added to the packet size for every ping that came back fine
+    queueing_slack = 0.05       # how much more than twice the fastest round trip counts as the network queueing
+    loss_gain = 1 / 8           # how quickly `loss` follows the pings, like TCP's RTT average
+    min_rtt_window = 10.0       # the fastest round trip is only remembered this long, in case the route changed
+
+    def __init__(self, max_rate: float, min_rate: float, max_mtu: int, min_mtu: int):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.max_mtu = max_mtu
+        self.min_mtu = min(min_mtu, max_mtu)
+        self.rate = max_rate
+        self.mtu = max_mtu
+        self.credit = 1.0           # snapshots we are allowed to send, one more every 1 / rate seconds
+
+        self.srtt = None            # type: typing.Optional[float]
+        self.rttvar = 0.0
+        self.min_rtt = None         # type: typing.Optional[float]
+        self.min_rtt_at = 0.0
+        self.loss = 0.0             # the fraction of pings lost lately
+
+        self.ping_seq = 0
+        self.pings = {}             # type: typing.Dict[int, float]
+        self.last_ping = None       # type: typing.Optional[float]
+        self.last_backoff = None    # type: typing.Optional[float]
+        self.pings_lost = 0
+        self.backoffs = 0
+
+    def due(self) -> bool:
+        """Called once per tick, returns if this client gets a snapshot this tick"""
+        self.credit = min(self.credit + self.rate / self.max_rate, 1.0)
+        if self.credit < 1.0:
+            return False
+        self.credit -= 1.0
+        return True
+
+    def timeout(self) -> float:
+        """How long until a ping that didn't come back counts as lost"""
+        if self.srtt is None:
+            return 1.0
+        return max(self.srtt + 4 * self.rttvar, 0.2)
+
+    def next_ping(self, now: float, interval: float) -> typing.Optional[int]:
+        """Gives the sequence of the ping to send, if it's time to send one"""
+        if self.last_ping is not None and now - self.last_ping < interval:
+            return None
+        self.last_ping = now
+        seq = self.ping_seq
+        self.ping_seq = (seq + 1) & 0xFFFF
+        self.pings[seq] = now
+        return seq
+
+    def on_pong(self, seq: int, now: float):
+        sent = self.pings.pop(seq, None)
+        if sent is None:
+            # Already counted as lost, or not one of ours
+            return
+        rtt = now - sent
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += (abs(self.srtt - rtt) - self.rttvar) / 4
+            self.srtt += (rtt - self.srtt) / 8
+        if self.min_rtt is None or rtt <= self.min_rtt or now - self.min_rtt_at > self.min_rtt_window:
+            self.min_rtt = rtt
+            self.min_rtt_at = now
+        self.loss -= self.loss * self.loss_gain
+
+        if rtt > 2 * self.min_rtt + self.queueing_slack:
+            self.back_off(now)
+        else:
+            self.rate = min(self.max_rate, self.rate + self.rate_step)
+            self.mtu = min(self.max_mtu, self.mtu + self.mtu_step)
+
+    def expire(self, now: float):
+        """Counts the pings that didn't come back in time as lost"""
+        timeout = self.timeout()
+        for seq in [seq for seq, sent in self.pings.items() if now - sent > timeout]:
+            self.pings.pop(seq)
+            self.pings_lost += 1
+            self.loss += (1 - self.loss) * self.loss_gain
+            self.back_off(now)
+
+    def back_off(self, now: float):
+        # A single congestion event usually shows up in a few pings, so only react to it once per round trip
+        if self.last_backoff is not None and now - self.last_backoff < (self.srtt or 0.0):
+            return
+        self.last_backoff = now
+        self.backoffs += 1
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.mtu = max(self.min_mtu, self.mtu // 2)
+
+    def as_dict(self) -> dict:
+        return {'rtt': self.srtt, 'min_rtt': self.min_rtt, 'loss': self.loss, 'rate': self.rate, 'mtu': self.mtu,
+                'pings_lost': self.pings_lost, 'backoffs': self.backoffs}
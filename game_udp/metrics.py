@@ -0,0 +1,235 @@
+"""
+Server Metrics for the Multiplayer Game Server
+By Jamal Bouajjaj, 2023
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import dataclasses
+import json
+import math
+import socket
+import threading
+import time
+import typing
+
+
+class Histogram:
+    """
+    A histogram of durations, in seconds, with logarithmic buckets (4 per doubling, starting at 1us).
+
+    Recording is O(1) and the memory is fixed, at the cost of the percentiles only being accurate to ~20%.
+    """
+    buckets_per_doubling = 4
+    n_buckets = 100         # up to 2^25 us, ~33s
+
+    def __init__(self):
+        self.counts = [0] * self.n_buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value: float):
+        us = value * 1e6
+        idx = int(math.log2(us) * self.buckets_per_doubling) + 1 if us >= 1 else 0
+        self.counts[min(idx, self.n_buckets - 1)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def bucket_top(self, idx: int) -> float:
+        """The upper bound of a bucket, in seconds"""
+        return 2 ** (idx / self.buckets_per_doubling) / 1e6
+
+    def percentile(self, p: float) -> float:
+        """The value (in seconds) under which `p` percent of the recorded values are"""
+        if self.count == 0:
+            return 0.0
+        target = self.count * p / 100
+        seen = 0
+        for idx, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return min(self.bucket_top(idx), self.max)
+        return self.max
+
+    def as_dict(self) -> dict:
+        return {'count': self.count,
+                'avg': self.total / self.count if self.count else 0.0,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99),
+                'max': self.max}
+
+
+@dataclasses.dataclass
+class ClientStats:
+    last_seen: float = 0.0
+    packets_in: int = 0
+    packets_out: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    last_packets_out: int = 0       # packets_out at the last snapshot, to get the send rate
+    link: typing.Optional[dict] = None      # the round trip, loss and send rate of the client, see `congestion.py`
+
+
+class Metrics:
+    """
+    Counters and histograms about what the server is doing.
+
+    They are updated by the server as it goes, and `snapshot` gives a JSON-able dict of them. All times are in
+    seconds, rates are per second since the previous snapshot.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.packets_in = 0
+        self.packets_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.tick_time = Histogram()
+        self.lock_wait = Histogram()
+        self.clients = {}       # type: typing.Dict[tuple, ClientStats]
+        self.last_snapshot = self.started
+
+    def add_client(self, ip: tuple):
+        self.clients[ip] = ClientStats(last_seen=time.monotonic())
+
+    def remove_client(self, ip: tuple):
+        self.clients.pop(ip, None)
+
+    def on_recv(self, ip: tuple, n_bytes: int):
+        self.packets_in += 1
+        self.bytes_in += n_bytes
+        c = self.clients.get(ip)
+        if c is not None:
+            c.last_seen = time.monotonic()
+            c.packets_in += 1
+            c.bytes_in += n_bytes
+
+    def on_send(self, ip: tuple, n_bytes: int):
+        self.packets_out += 1
+        self.bytes_out += n_bytes
+        c = self.clients.get(ip)
+        if c is not None:
+            c.packets_out += 1
+            c.bytes_out += n_bytes
+
+    def on_link(self, ip: tuple, link):
+        c = self.clients.get(ip)
+        if c is not None:
+            c.link = link.as_dict()
+
+    def on_tick(self, duration: float):
+        self.tick_time.record(duration)
+
+    def on_lock_wait(self, duration: float):
+        self.lock_wait.record(duration)
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        interval = max(now - self.last_snapshot, 1e-9)
+        self.last_snapshot = now
+        clients = {}
+        for ip, c in list(self.clients.items()):
+            clients[f"{ip[0]}:{ip[1]}"] = {
+                'last_seen_ago': now - c.last_seen,
+                'packets_in': c.packets_in,
+                'packets_out': c.packets_out,
+                'bytes_in': c.bytes_in,
+                'bytes_out': c.bytes_out,
+                'send_rate': (c.packets_out - c.last_packets_out) / interval,
+                'link': c.link,
+            }
+            c.last_packets_out = c.packets_out
+        return {
+            'uptime': now - self.started,
+            'packets_in': self.packets_in,
+            'packets_out': self.packets_out,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'tick_time': self.tick_time.as_dict(),
+            'lock_wait': self.lock_wait.as_dict(),
+            'clients': clients,
+        }
+
+
+class NullMetrics(Metrics):
+    """Metrics that don't record anything, for when they are disabled"""
+    enabled = False
+
+    def add_client(self, ip: tuple):
+        pass
+
+    def on_recv(self, ip: tuple, n_bytes: int):
+        pass
+
+    def on_send(self, ip: tuple, n_bytes: int):
+        pass
+
+    def on_link(self, ip: tuple, link):
+        pass
+
+    def on_tick(self, duration: float):
+        pass
+
+    def on_lock_wait(self, duration: float):
+        pass
+
+
+class StatsReporter:
+    """
+    A thread that makes the metrics available outside the server, in two ways:
+    - Every `interval` seconds, the metrics are written as JSON to `path`
+    - Any datagram sent to the UDP `port` gets the metrics as JSON back (i.e `echo | nc -u localhost 8090`)
+    """
+    def __init__(self, metrics: Metrics, port: typing.Optional[int] = None, path: typing.Optional[str] = None,
+                 interval: float = 5.0, host: str = "127.0.0.1"):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.exit = False
+        self.conn = None
+        if port is not None:
+            self.conn = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            self.conn.bind((host, port))
+            self.conn.settimeout(min(interval, 1.0))
+        self.t = threading.Thread(target=self.run, daemon=True, name="stats")
+
+    def start(self):
+        self.t.start()
+
+    def dump(self, max_size: typing.Optional[int] = None) -> bytes:
+        """The metrics as JSON. If it's over `max_size` bytes, the per-client stats are left out"""
+        snapshot = self.metrics.snapshot()
+        data = json.dumps(snapshot).encode()
+        if max_size is not None and len(data) > max_size:
+            snapshot['clients'] = len(snapshot['clients'])
+            data = json.dumps(snapshot).encode()
+        return data
+
+    def run(self):
+        next_dump = time.monotonic() + self.interval
+        while not self.exit:
+            if self.conn is not None:
+                try:
+                    _, r_from = self.conn.recvfrom(16)
+                    self.conn.sendto(self.dump(max_size=65000), r_from)
+                except socket.timeout:
+                    pass
+            else:
+                time.sleep(max(0.0, next_dump - time.monotonic()))
+            if self.path is not None and time.monotonic() >= next_dump:
+                next_dump += self.interval
+                with open(self.path, 'wb') as f:
+                    f.write(self.dump())
+
+    def close(self):
+        self.exit = True
+        self.t.join()
+        if self.conn is not None:
+            self.conn.close()
@@ -0,0 +1,87 @@
+"""
+NumPy Player Storage for the Multiplayer Game Server
+By Jamal Bouajjaj, 2023
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import typing
+import numpy as np
+
+from store import PlayerStore, pos_min, pos_max
+
+# Laid out exactly like a snapshot entry on the wire (`protocol.entry_codec`), so rows can be sent as-is
+entry_dtype = np.dtype([('id', '=i2'), ('x', '=i2'), ('y', '=i2')])
+
+
+class ArrayPlayerStore(PlayerStore):
+    """
+    A player table that keeps the ids and positions as a structure of arrays, so a whole snapshot is packed with
+    a single `tobytes()` instead of one `struct.pack` per player.
+
+    The rows are kept dense: removing a player moves the last row into its place. The `ClientObject`s are still
+    kept for everything else (address, color, acks, ...), and their `pos` is kept up to date as well.
+    """
+    def __init__(self, capacity: int = 64):
+        super().__init__()
+        self.rows = np.zeros(capacity, dtype=entry_dtype)
+        self.row_ips = []       # type: typing.List[tuple]
+        self.row_of = {}        # type: typing.Dict[tuple, int]
+
+    def add(self, client):
+        super().add(client)
+        n = len(self.row_ips)
+        if n == len(self.rows):
+            self.rows = np.resize(self.rows, n * 2)
+        self.rows[n] = (client.id, client.pos[0], client.pos[1])
+        self.row_ips.append(client.ip)
+        self.row_of[client.ip] = n
+
+    def remove(self, ip: tuple):
+        row = self.row_of.pop(ip)
+        last = len(self.row_ips) - 1
+        if row != last:
+            self.rows[row] = self.rows[last]
+            self.row_ips[row] = self.row_ips[last]
+            self.row_of[self.row_ips[row]] = row
+        self.row_ips.pop()
+        return super().remove(ip)
+
+    def set_pos(self, ip: tuple, pos: tuple):
+        super().set_pos(ip, pos)
+        row = self.row_of[ip]
+        self.rows['x'][row] = pos[0]
+        self.rows['y'][row] = pos[1]
+
+    def quantized_rows(self, q: int = 1) -> np.ndarray:
+        """The rows of every player, with their positions quantized to `q` pixels"""
+        rows = self.rows[:len(self.row_ips)]
+        if q == 1:
+            return rows
+        rows = rows.copy()
+        for col in ('x', 'y'):
+            # In 32 bits, so the rounding up near the edges doesn't wrap around, then clamped back into 16 bits
+            rows[col] = np.clip((rows[col].astype(np.int32) + q // 2) // q * q, pos_min, pos_max)
+        return rows
+
+    def positions(self, q: int = 1) -> typing.Dict[int, tuple]:
+        # Quantize all of them at once, then only go through Python to build the dictionary
+        rows = self.quantized_rows(q)
+        return dict(zip(rows['id'].tolist(), zip(rows['x'].tolist(), rows['y'].tolist())))
+
+    def pack_all(self, q: int = 1) -> bytes:
+        return self.quantized_rows(q).tobytes()
+
+    @staticmethod
+    def pack(entries: typing.List[tuple]) -> bytes:
+        rows = np.empty(len(entries), dtype=entry_dtype)
+        if entries:
+            ids, pos = zip(*entries)
+            xy = np.array(pos, dtype='=i2').reshape(-1, 2)
+            rows['id'] = ids
+            rows['x'] = xy[:, 0]
+            rows['y'] = xy[:, 1]
+        return rows.tobytes()
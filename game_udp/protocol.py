@@ -0,0 +1,252 @@
+"""
+Wire Protocol of the Multiplayer Game
+By Jamal Bouajjaj, 2023
+
+The opcodes and message layouts shared by the server and the client, see the Protocol section of the README.
+
+Every message starts with the `0xFF` escape and its opcode, and each message class has a precompiled `struct.Struct`
+for the whole message, escape and opcode included. There's two ways to use them:
+- As objects, i.e `PlayerJoined(3, 1).encode()` or `decode(data)`, which is the easy way
+- Through `pack` and `pack_into` (and the codecs directly for decoding), which skip creating an object, for the
+  hot paths, i.e `PlayerJoined.pack(3, 1)`
+`pack_into` writes into a caller's buffer, so a message can be built in place without joining `bytes` together.
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import functools
+import struct
+import typing
+
+ESCAPE = 0xFF
+
+# Client -> server
+JOIN = 0xA0
+POS = 0x01
+ACK = 0x02
+PONG = 0x31                 # the answer to a ping
+LEAVE = 0xF0
+
+# Server -> client
+JOIN_ACCEPT = 0xA1
+JOIN_REJECT = 0xA2
+WORLD = 0x10                # legacy snapshot, without a sequence
+SNAPSHOT = 0x11
+SNAPSHOT_FRAGMENT = 0x12
+PLAYER_JOINED = 0x20
+PLAYER_LEFT = 0x21
+PING = 0x30                 # to measure the round trip time and the loss, see `congestion.py`
+SHUTDOWN = 0xE0
+LEAVE_ACK = 0xF1
+
+KEYFRAME = 0x01             # snapshot flag: a full snapshot instead of a delta
+
+# Either way, on a server with rooms (see `rooms.py`) every message is prefixed by the room it's for
+ROOM = 0xFE
+room_header = struct.Struct("=BH")      # 0xFE, room id
+
+# The player colors, indexed by the color the server gives out
+colors = ["red", "green", "blue", "cyan", "orange", "white", "aqua", "blueviolet", "darkred", "fuchsia"]
+
+entry_codec = struct.Struct("=hhh")     # a player in a snapshot: (ID, x pos, y pos)
+
+
+def decode_entries(data, positions: typing.Dict[int, tuple]):
+    """
+    Decodes the `(ID, x pos, y pos)` entries of a snapshot into `positions`. `data` can be a `memoryview` into the
+    received packet, so that nothing gets copied
+    """
+    for p_id, posx, posy in entry_codec.iter_unpack(data):
+        positions[p_id] = (posx, posy)
+
+
+class Message:
+    """
+    The base of every message. Subclasses set their `opcode`, the `codec` of the whole message, and name their fields
+    in `__slots__`, in the order they are in the codec
+    """
+    __slots__ = ()
+    opcode = None           # type: int
+    codec = struct.Struct("=BB")
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Bind the escape and opcode once, so that packing a message is a single call into its codec
+        cls.pack = functools.partial(cls.codec.pack, ESCAPE, cls.opcode)
+
+    def __init__(self, *fields):
+        for name, value in zip(self.__slots__, fields):
+            setattr(self, name, value)
+
+    def fields(self) -> tuple:
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    @classmethod
+    def pack_into(cls, buf, offset: int, *fields) -> int:
+        """Writes the message into `buf` at `offset`, returning the offset right after it"""
+        cls.codec.pack_into(buf, offset, ESCAPE, cls.opcode, *fields)
+        return offset + cls.codec.size
+
+    def encode(self) -> bytes:
+        return self.pack(*self.fields())
+
+    def encode_into(self, buf, offset: int = 0) -> int:
+        return self.pack_into(buf, offset, *self.fields())
+
+    @classmethod
+    def decode(cls, data) -> 'Message':
+        return cls(*cls.codec.unpack_from(data)[2:])
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.fields() == other.fields()
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{n}={getattr(self, n)!r}' for n in self.__slots__)})"
+
+
+class Join(Message):
+    __slots__ = ()
+    opcode = JOIN
+
+
+class Pos(Message):
+    __slots__ = ('x', 'y')
+    opcode = POS
+    codec = struct.Struct("=BBhh")
+
+
+class Ack(Message):
+    __slots__ = ('seq',)
+    opcode = ACK
+    codec = struct.Struct("=BBH")
+
+
+class Pong(Message):
+    __slots__ = ('seq',)
+    opcode = PONG
+    codec = struct.Struct("=BBH")
+
+
+class Leave(Message):
+    __slots__ = ()
+    opcode = LEAVE
+
+
+class JoinAccept(Message):
+    __slots__ = ('id', 'color')
+    opcode = JOIN_ACCEPT
+    codec = struct.Struct("=BBhh")
+
+
+class JoinReject(Message):
+    __slots__ = ()
+    opcode = JOIN_REJECT
+
+
+class PlayerJoined(Message):
+    __slots__ = ('id', 'color')
+    opcode = PLAYER_JOINED
+    codec = struct.Struct("=BBhh")
+
+
+class PlayerLeft(Message):
+    __slots__ = ('id',)
+    opcode = PLAYER_LEFT
+    codec = struct.Struct("=BBh")
+
+
+class Ping(Message):
+    __slots__ = ('seq',)
+    opcode = PING
+    codec = struct.Struct("=BBH")
+
+
+class Shutdown(Message):
+    __slots__ = ()
+    opcode = SHUTDOWN
+
+
+class LeaveAck(Message):
+    __slots__ = ()
+    opcode = LEAVE_ACK
+
+
+class EntriesMessage(Message):
+    """
+    A message whose `codec` is only its header, followed by `count` snapshot entries. The entries are kept packed in
+    `body`, which `decode` gives as a `memoryview` of the data, see `decode_entries`
+    """
+    __slots__ = ()
+
+    @classmethod
+    def size(cls, count: int) -> int:
+        return cls.codec.size + entry_codec.size * count
+
+    def encode(self) -> bytes:
+        buf = bytearray(self.size(self.count))
+        self.encode_into(buf)
+        return bytes(buf)
+
+    def encode_into(self, buf, offset: int = 0) -> int:
+        offset = self.pack_into(buf, offset, *self.fields()[:-1])
+        end = offset + len(self.body)
+        buf[offset:end] = self.body
+        return end
+
+    @classmethod
+    def decode(cls, data) -> typing.Optional['Message']:
+        """Decodes the message, or returns None if it's cut short of the `count` entries its header says it has"""
+        header = cls.codec.unpack_from(data)
+        start = cls.codec.size
+        count = header[-1]
+        if len(data) < cls.size(count):
+            return None
+        return cls(*header[2:], memoryview(data)[start:start + entry_codec.size * count])
+
+    def positions(self) -> typing.Dict[int, tuple]:
+        positions = {}
+        decode_entries(self.body, positions)
+        return positions
+
+
+class World(EntriesMessage):
+    __slots__ = ('count', 'body')
+    opcode = WORLD
+    codec = struct.Struct("=BBB")
+
+
+class Snapshot(EntriesMessage):
+    __slots__ = ('seq', 'server_ms', 'flags', 'count', 'body')
+    opcode = SNAPSHOT
+    codec = struct.Struct("=BBHIBH")
+
+
+class SnapshotFragment(EntriesMessage):
+    __slots__ = ('seq', 'server_ms', 'flags', 'frag_idx', 'frag_count', 'count', 'body')
+    opcode = SNAPSHOT_FRAGMENT
+    codec = struct.Struct("=BBHIBBBH")
+
+
+message_types = {cls.opcode: cls for cls in (Join, Pos, Ack, Pong, Leave, JoinAccept, JoinReject, PlayerJoined,
+                                             PlayerLeft, Ping, Shutdown, LeaveAck, World, Snapshot,
+                                             SnapshotFragment)}
+
+
+def decode(data) -> typing.Optional[Message]:
+    """Decodes any message, or returns None if it isn't one or is too short"""
+    if len(data) < 2 or data[0] != ESCAPE:
+        return None
+    cls = message_types.get(data[1])
+    if cls is None or len(data) < cls.codec.size:
+        return None
+    return cls.decode(data)
+
+
+def unwrap_room(data) -> typing.Tuple[typing.Optional[int], typing.Any]:
+    """Splits a message in (room id, the message itself). The room is None if it doesn't have the room prefix"""
+    if len(data) >= room_header.size and data[0] == ROOM:
+        return room_header.unpack_from(data)[1], data[room_header.size:]
+    return None, data
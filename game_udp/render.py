@@ -0,0 +1,102 @@
+"""
+Renderers for the Multiplayer Game Client
+By Jamal Bouajjaj, 2023
+
+Both draw the players as circles, given every frame as a dictionary of `{key: (color, (x, y))}`:
+- `FullRenderer` clears and redraws the whole window every frame, then flips it
+- `DirtyRectRenderer` only redraws around the circles that moved, and only updates those parts of the window.
+  A frame where nothing moved isn't presented at all
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import typing
+
+import pygame
+
+
+class FullRenderer:
+    """Redraws the whole window every frame, even if nothing moved"""
+    def __init__(self, screen: pygame.Surface, radius: int = 30, background="black"):
+        self.screen = screen
+        self.radius = radius
+        self.background = background
+        self.frames = 0         # frames that were presented
+
+    def invalidate(self):
+        """Asks for the whole window to be redrawn next frame, i.e after it got uncovered"""
+        pass
+
+    def draw(self, circles: typing.Dict[typing.Any, tuple]) -> bool:
+        """Draws a frame, returns if anything was presented"""
+        self.screen.fill(self.background)
+        for color, pos in circles.values():
+            pygame.draw.circle(self.screen, color, pos, self.radius)
+        pygame.display.flip()
+        self.frames += 1
+        return True
+
+
+class DirtyRectRenderer(FullRenderer):
+    """
+    Remembers where each circle was drawn last frame. The circles that moved, appeared, disappeared or changed color
+    get erased from where they were and drawn where they are now, along with the parts of any other circle
+    overlapping those areas, and only those areas are sent to the display with `pygame.display.update`.
+
+    Positions are rounded to the pixel before being compared, so sub-pixel movement doesn't count as moving.
+    """
+    def __init__(self, screen: pygame.Surface, radius: int = 30, background="black"):
+        super().__init__(screen, radius, background)
+        self.drawn = {}         # type: typing.Dict[typing.Any, tuple]
+        self.full_redraw = True
+
+    def invalidate(self):
+        self.full_redraw = True
+
+    def rect(self, pos: tuple) -> pygame.Rect:
+        """The area a circle at `pos` covers"""
+        r = self.radius
+        # One more pixel around it, for the anti-aliasing of the circle's edge
+        return pygame.Rect(pos[0] - r - 1, pos[1] - r - 1, 2 * r + 2, 2 * r + 2)
+
+    def draw(self, circles: typing.Dict[typing.Any, tuple]) -> bool:
+        now = {}
+        for key, (color, pos) in circles.items():
+            now[key] = (color, (round(pos[0]), round(pos[1])))
+
+        if self.full_redraw:
+            self.full_redraw = False
+            self.drawn = now
+            super().draw(now)
+            return True
+
+        dirty = []
+        for key, drawn in self.drawn.items():
+            if now.get(key) != drawn:
+                dirty.append(self.rect(drawn[1]))
+        for key, (color, pos) in now.items():
+            if self.drawn.get(key) != (color, pos):
+                dirty.append(self.rect(pos))
+        if not dirty:
+            return False
+
+        # Redraw each area from scratch, with everything touching it in the same order as a full redraw, clipped to
+        # the area so the circles around it don't get drawn over the ones that were on top of them
+        rects = [(self.rect(pos), color, pos) for color, pos in now.values()]
+        for area in dirty:
+            self.screen.set_clip(area)
+            self.screen.fill(self.background)
+            for rect, color, pos in rects:
+                if area.colliderect(rect):
+                    pygame.draw.circle(self.screen, color, pos, self.radius)
+        self.screen.set_clip(None)
+        pygame.display.update(dirty)
+        self.drawn = now
+        self.frames += 1
+        return True
+
+
+renderers = {'full': FullRenderer, 'dirty': DirtyRectRenderer}
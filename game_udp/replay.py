@@ -0,0 +1,128 @@
+"""
+Capture Replay for the Multiplayer Game Server
+By Jamal Bouajjaj, 2023
+
+Feeds a capture made with `python server.py --capture FILE` back into the server's packet handling and ticks,
+without any socket, for repeatable benchmarks and profiling runs, i.e:
+    python replay.py session.cap --speed max --profile
+
+The game's clock runs off the capture's timestamps, so the same capture always gives the same ticks, the same
+timeouts and the same snapshots, whatever speed it gets replayed at. What the server sends goes to a sink that only
+counts it.
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import argparse
+import cProfile
+import json
+import logging
+import pstats
+import time
+import typing
+
+from capture import CaptureReader
+from metrics import Histogram
+from server import GameServer
+
+
+class ReplayServer(GameServer):
+    """
+    A server engine without a socket: `replay` hands it the captured datagrams, and runs its ticks in between them
+    at `tick_rate`, in the capture's time
+    """
+    def __init__(self):
+        self.now = 0.0
+        super().__init__()
+        self.packets_out = 0
+        self.bytes_out = 0
+        self.handle_time = Histogram()
+
+    def clock(self) -> float:
+        return self.now
+
+    def transmit(self, data: bytes, ip: tuple):
+        self.packets_out += 1
+        self.bytes_out += len(data)
+
+    def replay(self, reader: CaptureReader, speed: typing.Optional[float] = 1.0) -> dict:
+        """
+        Replays a whole capture, `speed` times faster than it was recorded, or as fast as possible if None.
+        Returns the stats of the run
+        """
+        period = 1 / self.tick_rate
+        start = None
+        next_tick = None
+        wall_start = time.perf_counter()
+        packets_in = 0
+        for t, addr, data in reader:
+            if start is None:
+                start = t
+                next_tick = t
+            # Run the ticks that were due before this datagram came in
+            while next_tick <= t:
+                self.now = next_tick - start
+                self.ticker.tick(self.tick)
+                next_tick += period
+            if speed is not None:
+                time.sleep(max(0.0, wall_start + (t - start) / speed - time.perf_counter()))
+            self.now = t - start
+            handle_start = time.perf_counter()
+            self.handle_packet(data, addr)
+            self.handle_time.record(time.perf_counter() - handle_start)
+            packets_in += 1
+        elapsed = time.perf_counter() - wall_start
+        return {
+            'packets_in': packets_in,
+            'capture_duration': self.now,
+            'wall_time': elapsed,
+            'packets_per_sec': packets_in / elapsed if elapsed else 0.0,
+            'handle_time': self.handle_time.as_dict(),
+            'ticks': self.ticker.stats.as_dict(),
+            'packets_out': self.packets_out,
+            'bytes_out': self.bytes_out,
+            'players_left': len(self.clients),
+        }
+
+
+def parse_speed(s: str) -> typing.Optional[float]:
+    return None if s == 'max' else float(s)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replays a capture into the game server, without sockets")
+    parser.add_argument('capture', help="the capture file, from `server.py --capture`")
+    parser.add_argument('--speed', type=parse_speed, default=1.0,
+                        help="how many times faster than recorded to replay, or `max` for as fast as possible")
+    parser.add_argument('--tick-rate', type=float, default=GameServer.tick_rate, help="server ticks per second")
+    parser.add_argument('--store', choices=['dict', 'numpy'], default='dict', help="how the player table is stored")
+    parser.add_argument('--profile', action='store_true', help="run under cProfile and print the top functions")
+    parser.add_argument('--report', help="write the JSON stats to this file instead of stdout")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    ReplayServer.tick_rate = args.tick_rate
+    if args.store == 'numpy':
+        from numpy_store import ArrayPlayerStore
+        ReplayServer.store = ArrayPlayerStore
+
+    reader = CaptureReader(args.capture)
+    srv = ReplayServer()
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    stats = srv.replay(reader, args.speed)
+    if profiler is not None:
+        profiler.disable()
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+    reader.close()
+
+    report = json.dumps(stats, indent=2)
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
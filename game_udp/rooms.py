@@ -0,0 +1,189 @@
+"""
+Multi-Room Multiplayer Game Server
+By Jamal Bouajjaj, 2023
+
+Hosts many independent rooms (matches) in one process, on one UDP port. Every message is prefixed with
+`0xFE | (room id, 2 bytes)` (see `protocol.room_header`), which the server uses to hand each packet to its room.
+
+Each room is a whole `GameServer` of its own: its own players, ids, colors and tick. A room is opened by the first
+player that joins it, and closed once it's empty.
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import argparse
+import concurrent.futures
+import logging
+import socket
+import threading
+import time
+import typing
+
+import protocol
+from server import GameServer, StrayReplies
+from ticker import TickScheduler
+
+
+class Room(GameServer):
+    """One room. It sends through the `RoomServer`'s socket, with its room prefix in front of every message"""
+    def __init__(self, host: 'RoomServer', room_id: int):
+        super().__init__()
+        self.host = host
+        self.room_id = room_id
+        self.log = logging.getLogger(f'room{room_id}')
+        self.prefix = protocol.room_header.pack(protocol.ROOM, room_id)
+        self.lock = threading.Lock()
+        self.closed = False         # set, under `lock`, once it's taken out of the server's rooms
+
+    def transmit(self, data: bytes, ip: tuple):
+        self.host.transmit(self.prefix, data, ip)
+
+    def run_ticks(self, n: int):
+        """Runs the `n` ticks that are due, this is what runs on the worker pool"""
+        for _ in range(n):
+            self.ticker.tick(self.locked_tick)
+        self.report_ticks()
+
+    def locked_tick(self):
+        with self.lock:
+            self.tick()
+
+
+class RoomServer:
+    """
+    The socket and the rooms. A thread receives the packets and hands them to their room, like the `thread` engine
+    of `server.py`. The main loop submits the ticks of the rooms that are due to a pool of `workers` threads.
+
+    Each room has its own lock, so a room's packets and its tick don't run at the same time, but different rooms
+    don't wait on each other. The pool mostly helps with the sends, which let go of the GIL.
+    """
+    addr = GameServer.addr
+    max_rooms = 256
+    workers = None          # threads in the pool, None for `ThreadPoolExecutor`'s default
+    room = Room
+
+    def __init__(self):
+        self.exit = False
+        self.log = logging.getLogger('rooms')
+        self.conn = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.conn.settimeout(2)
+        self.t = threading.Thread(target=self.run_thread)
+        self.pool = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix='room')
+        self.rooms = {}         # type: typing.Dict[int, Room]
+        # Only held to look up, open or close rooms. When both are needed it's taken before a room's lock, never after
+        self.rooms_lock = threading.Lock()
+        self.strays = StrayReplies(GameServer.stray_interval)
+
+    def transmit(self, prefix: bytes, data: bytes, ip: tuple):
+        # Send the prefix and the message as two buffers of one datagram, instead of copying them together
+        self.conn.sendmsg([prefix, data], [], 0, ip)
+
+    def handle_packet(self, r: bytes, r_from: tuple):
+        room_id, data = protocol.unwrap_room(memoryview(r))
+        if room_id is None or len(data) < 2:
+            return
+        while True:
+            with self.rooms_lock:
+                room = self.rooms.get(room_id)
+                if room is None:
+                    # Only a join opens a room
+                    if data[0] != protocol.ESCAPE or data[1] != protocol.JOIN:
+                        if data[0] == protocol.ESCAPE and data[1] in protocol.message_types:
+                            # i.e the room closed after its last player timed out, but that player is still running
+                            reply = self.strays.reply(data[1], r_from, time.monotonic())
+                            if reply is not None:
+                                self.transmit(protocol.room_header.pack(protocol.ROOM, room_id), reply, r_from)
+                        return
+                    if len(self.rooms) >= self.max_rooms:
+                        self.transmit(protocol.room_header.pack(protocol.ROOM, room_id), protocol.JoinReject.pack(),
+                                      r_from)
+                        return
+                    room = self.rooms[room_id] = self.room(self, room_id)
+                    self.log.info(f"Opened room {room_id}, {len(self.rooms)} rooms open")
+            # The room's lock is taken once the rooms' is let go, so waiting for this room's tick doesn't hold up the
+            # packets of the other rooms, or the tick loop
+            with room.lock:
+                if not room.closed:
+                    room.handle_packet(data, r_from)
+                    return
+            # It got closed while we waited for it, so look it up again, a join opens a new one
+
+    def run_thread(self):
+        while not self.exit:
+            try:
+                r, r_from = self.conn.recvfrom(1024)
+            except socket.timeout:
+                continue
+            self.handle_packet(r, r_from)
+
+    def tick_rooms(self):
+        """Runs the ticks of every room that has some due on the pool, waits for them, and closes the empty rooms"""
+        with self.rooms_lock:
+            rooms = list(self.rooms.values())
+        futures = []
+        for room in rooms:
+            n = room.ticker.due()
+            if n:
+                futures.append(self.pool.submit(room.run_ticks, n))
+        for f in concurrent.futures.as_completed(futures):
+            f.result()
+
+        with self.rooms_lock:
+            for room in rooms:
+                with room.lock:
+                    if len(room.clients) == 0:
+                        room.closed = True
+                        self.rooms.pop(room.room_id, None)
+                        self.log.info(f"Closed room {room.room_id}, {len(self.rooms)} rooms open")
+
+    def delay(self) -> float:
+        """The time until the next room's tick is due"""
+        with self.rooms_lock:
+            rooms = list(self.rooms.values())
+        return min((room.ticker.delay() for room in rooms), default=0.1)
+
+    def run(self):
+        self.conn.bind(self.addr)
+        self.t.start()
+        try:
+            while not self.exit:
+                time.sleep(self.delay())
+                self.tick_rooms()
+        except KeyboardInterrupt:
+            pass
+
+    def close(self):
+        print("Closing socket")
+        with self.rooms_lock:
+            for room in self.rooms.values():
+                with room.lock:
+                    room.notify_shutdown()
+        self.exit = True
+        self.t.join()
+        self.pool.shutdown()
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Multiplayer game server example, with many rooms on one port")
+    parser.add_argument('--port', type=int, default=GameServer.addr[1], help="the UDP port to listen on")
+    parser.add_argument('--tick-rate', type=float, default=GameServer.tick_rate, help="each room's ticks per second")
+    parser.add_argument('--tick-policy', choices=[TickScheduler.SKIP, TickScheduler.CATCH_UP],
+                        default=GameServer.tick_policy, help="what to do with ticks a room was too late for")
+    parser.add_argument('--max-rooms', type=int, default=RoomServer.max_rooms, help="the most rooms open at once")
+    parser.add_argument('--workers', type=int, help="threads running the rooms' ticks")
+    args = parser.parse_args()
+
+    RoomServer.addr = (RoomServer.addr[0], args.port)
+    RoomServer.max_rooms = args.max_rooms
+    RoomServer.workers = args.workers
+    GameServer.tick_rate = args.tick_rate
+    GameServer.tick_policy = args.tick_policy
+
+    logging.basicConfig(level=logging.INFO)
+    srv = RoomServer()
+    srv.run()
+    srv.close()
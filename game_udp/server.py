@@ -13,12 +13,19 @@ import threading
 import queue
 import typing
 import time
-import struct
 import sys
 import logging
 import dataclasses
-import pygame
-import random
+import asyncio
+import argparse
+import protocol
+from protocol import colors
+from spatial import SpatialGrid
+from allocator import IdAllocator
+from congestion import LinkState
+from store import PlayerStore, quantize_pos
+from ticker import TickScheduler
+from metrics import Metrics, NullMetrics, StatsReporter
 
 
 @dataclasses.dataclass
@@ -27,127 +34,516 @@ class ClientObject:
     id: int
     color_idx: int
     pos: tuple = (-50, -50)
+    last_seen: float = 0.0                      # `clock()` of the last packet from this client
+    acked_seq: typing.Optional[int] = None      # last snapshot sequence this client acknowledged
+    last_keyframe: typing.Optional[int] = None  # sequence of the last full snapshot sent to this client
+    link: typing.Optional[LinkState] = None     # how much to send this client, see `congestion.py`
+    # what this client knows of the world after each snapshot sent to it, by sequence number
+    known: typing.Dict[int, typing.Dict[int, tuple]] = dataclasses.field(default_factory=dict)
+    # the players (and their positions) each snapshot sent to it since `acked_seq` carried, by sequence number
+    sent: typing.Dict[int, typing.Dict[int, tuple]] = dataclasses.field(default_factory=dict)
 
 
-# note: this must be the same as the server
-colors = ["red", "green", "blue", "cyan", "orange", "white", "aqua", "blueviolet", "darkred", "fuchsia"]
+class StrayReplies:
+    """
+    Answers the packets from addresses that aren't players, i.e a client that got timed out but is still running,
+    so that it stops instead of playing on its own. A `0xF0` gets its `0xF1` (the first one was lost), anything else
+    a `0xE0`.
 
+    Each address gets at most one answer every `interval` seconds, so spoofed packets can't make us flood someone
+    """
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.last = {}          # type: typing.Dict[tuple, float]
+        self.last_prune = 0.0
 
-class ServerHandler:
+    def reply(self, command: int, ip: tuple, now: float) -> typing.Optional[bytes]:
+        """The message to answer `command` from `ip` with, or None if it already got one not long ago"""
+        if now - self.last_prune >= self.interval:
+            self.last_prune = now
+            for old in [a for a, t in self.last.items() if now - t >= self.interval]:
+                del self.last[old]
+        if ip in self.last:
+            return None
+        self.last[ip] = now
+        return protocol.LeaveAck.pack() if command == protocol.LEAVE else protocol.Shutdown.pack()
+
+
+class GameServer:
+    """
+    The game logic of the server: the player table, handling the packets from the clients, and building the
+    snapshots that get sent back to them.
+
+    This doesn't own any socket. The engines below subclass this, and provide `send` and their own way of receiving
+    packets and ticking `update_clients`.
+    """
     addr = ("0.0.0.0", 8080)
-    max_players = len(colors)
+    tick_rate = 60
+    tick_policy = TickScheduler.SKIP    # what to do with the ticks we were too late for, see `TickScheduler`
+    tick_report_interval = 10.0         # how often, in seconds, the tick timing stats get logged
+    max_players = 1000
+    unbounded_palette = True    # once every color in `colors` is taken, give out colors past it instead of rejecting
+    delta_snapshots = True      # only send the players that moved since the client's last acknowledged snapshot
+    keyframe_interval = 60      # every this many ticks each client gets a full snapshot to re-sync it
+    pos_quantize = 2            # positions are snapped to this many pixels before being compared/sent
+    snapshot_history = 64       # how many past snapshots are kept to delta against
+    aoi_radius = None           # if set, clients only get the players within this many pixels of them
+    snapshot_mtu = 1200         # snapshots bigger than this get split in multiple 0x12 fragments
+    store = PlayerStore         # how the player table is stored, see `store.py` and `numpy_store.py`
+    metrics_enabled = False     # keep count of packets, bytes, tick times, ... see `metrics.py`
+    client_timeout = 10.0       # clients that didn't send anything for this many seconds are dropped, None to never
+    reap_interval = 1.0         # how often, in seconds, to look for clients that timed out
+    stray_interval = 1.0        # the least time, in seconds, between two answers to an address that isn't a player
+    clock = staticmethod(time.monotonic)    # the game's time, in seconds. The replay tool runs it off the capture
+    capture = None              # if set, a `capture.CaptureWriter` that every received datagram is recorded to
+    congestion_control = True   # adapt each client's snapshot rate and packet size to its link, see `congestion.py`
+    ping_interval = 0.25        # how often, in seconds, each client gets pinged
+    min_send_rate = 10          # the fewest snapshots a second a client gets, however bad its link
+    min_mtu = 508               # the smallest packets a client's snapshots get split into, in bytes
 
     def __init__(self):
-        self.conn = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        self.conn.settimeout(2)
-        self.t = threading.Thread(target=self.run_thread)
         self.exit = False
-        self.clock = pygame.time.Clock()
+        self.started = self.clock()
         self.log = logging.getLogger('server')
 
-        self.clients = {}       # type: typing.Dict[tuple, ClientObject]
-        self.client_lock = threading.Lock()
+        self.clients = self.store()
 
-    def run(self):
-        self.conn.bind(self.addr)
-        self.t.start()
-        while not self.exit:
-            with self.client_lock:
-                self.update_clients()
-            try:
-                self.clock.tick(60)
-            except KeyboardInterrupt:
-                break
+        self.ids = IdAllocator(0, 0x8000)
+        self.color_ids = IdAllocator(0, 0x8000 if self.unbounded_palette else len(colors), recycle_first=True)
 
-    def run_thread(self):
-        while not self.exit:
-            try:
-                r, r_from = self.conn.recvfrom(1024)
-                self.log.debug(f"Recv {r} from {r_from}")
-            except socket.timeout:
-                continue
-            if r[0] != 0xFF:
-                continue
-            command = r[1]
-            data = r[2:]
-            with self.client_lock:
-                if command == 0xA0:
-                    self.add_player(r_from)
-                elif command == 0x01:
-                    pos = struct.unpack("hh", data)
-                    self.clients[r_from].pos = pos
-                elif command == 0xF0:
-                    self.remove_player(r_from)
+        self.snap_seq = 0
+        # Only kept up to date if there's an area of interest to look players up in
+        self.grid = SpatialGrid(self.aoi_radius) if self.aoi_radius is not None else None
+
+        self.ticker = TickScheduler(self.tick_rate, self.tick_policy)
+        self.last_tick_report = self.clock()
+        self.last_reap = self.clock()
+        self.strays = StrayReplies(self.stray_interval)
+
+        self.metrics = Metrics() if self.metrics_enabled else NullMetrics()
+        if self.metrics.enabled:
+            self.ticker.on_work = self.metrics.on_tick
+
+    def send(self, data: bytes, ip: tuple):
+        """Sends a datagram to a client"""
+        self.metrics.on_send(ip, len(data))
+        self.transmit(data, ip)
+
+    def transmit(self, data: bytes, ip: tuple):
+        """Actually puts a datagram on the wire, this is up to the engine"""
+        raise NotImplementedError
+
+    def handle_packet(self, r: bytes, r_from: tuple):
+        """Processes one datagram received from a client"""
+        self.metrics.on_recv(r_from, len(r))
+        if self.capture is not None:
+            self.capture.write(r, r_from)
+        if len(r) < 2 or r[0] != protocol.ESCAPE:
+            return
+        command = r[1]
+        msg = protocol.message_types.get(command)
+        if msg is None or len(r) < msg.codec.size:
+            # Not something we know, or cut short
+            return
+        if command == protocol.JOIN:
+            self.add_player(r_from)
+            return
+        c = self.clients.get(r_from)
+        if c is None:
+            # Not one of our players, i.e one that timed out, or a late packet after it left
+            reply = self.strays.reply(command, r_from, self.clock())
+            if reply is not None:
+                self.send(reply, r_from)
+            return
+        # Anything the client sends counts as it being alive, its position keep-alive is its heartbeat
+        c.last_seen = self.clock()
+        if command == protocol.POS:
+            pos = protocol.Pos.codec.unpack_from(r)[2:]
+            self.clients.set_pos(r_from, pos)
+            if self.grid is not None:
+                self.grid.move(c.id, pos)
+        elif command == protocol.ACK:
+            seq = protocol.Ack.codec.unpack_from(r)[2]
+            # Acks can arrive out of order, only ever move forward
+            if c.acked_seq is None or 0 < ((seq - c.acked_seq) & 0xFFFF) < 0x8000:
+                c.acked_seq = seq
+                # The snapshots up to this one can't be on the client's side in any other way anymore
+                for s in [s for s in c.sent if ((seq - s) & 0xFFFF) < 0x8000]:
+                    del c.sent[s]
+        elif command == protocol.PONG:
+            c.link.on_pong(protocol.Pong.codec.unpack_from(r)[2], c.last_seen)
+            self.metrics.on_link(r_from, c.link)
+        elif command == protocol.LEAVE:
+            self.remove_player(r_from)
 
     def add_player(self, ip: tuple):
-        if len(self.clients) >= self.max_players:
-            self.conn.sendto(b'\xFF\xA2', ip)
+        if ip in self.clients:
+            # Our accept got lost, so the client is asking again
+            c = self.clients[ip]
+            c.last_seen = self.clock()
+            self.send(protocol.JoinAccept.pack(c.id, c.color_idx), ip)
+            return
+        # The legacy 0x10 snapshot only has one byte for the player count
+        max_players = self.max_players if self.delta_snapshots else min(self.max_players, 255)
+        if len(self.clients) >= max_players:
+            self.send(protocol.JoinReject.pack(), ip)
             return
-        p_id = self.generate_new_id()
-        new_color = random.randint(0, len(colors)-1)
-        # todo: check if player is already in IP list
-        self.conn.sendto(b'\xFF\xA1' + struct.pack("hh", p_id, new_color), ip)
+        p_id = self.ids.allocate()
+        new_color = self.color_ids.allocate()
+        if p_id is None or new_color is None:
+            if p_id is not None:
+                self.ids.release(p_id)
+            self.send(protocol.JoinReject.pack(), ip)
+            return
+        self.send(protocol.JoinAccept.pack(p_id, new_color), ip)
         # Update all the other clients about the new player
+        joined = protocol.PlayerJoined.pack(p_id, new_color)
         for f in self.clients.values():
             # Update the other connected client about the new player
-            self.conn.sendto(b'\xFF\x20' + struct.pack("hh", p_id, new_color), f.ip)
+            self.send(joined, f.ip)
             # Update the just-connected client about the other players
-            self.conn.sendto(b'\xFF\x20' + struct.pack("hh", f.id, f.color_idx), ip)
+            self.send(protocol.PlayerJoined.pack(f.id, f.color_idx), ip)
 
-        self.clients[ip] = ClientObject(ip=ip, id=p_id, color_idx=new_color)
+        link = LinkState(self.tick_rate, self.min_send_rate, self.snapshot_mtu, self.min_mtu)
+        self.clients.add(ClientObject(ip=ip, id=p_id, color_idx=new_color, last_seen=self.clock(), link=link))
+        self.metrics.add_client(ip)
+        if self.grid is not None:
+            self.grid.insert(p_id, self.clients[ip].pos)
         self.log.info(f"Player from ip {ip} joined!")
 
-    def remove_player(self, ip: tuple):
+    def remove_player(self, ip: tuple, timed_out: bool = False):
         p_id = self.clients[ip].id
-        self.log.info(f"Removing player {self.clients[ip]}")
+        if timed_out:
+            self.log.info(f"Player {p_id} from ip {ip} timed out")
+        else:
+            self.log.info(f"Removing player {p_id} from ip {ip}")
+        left = protocol.PlayerLeft.pack(p_id)
         for f in self.clients.values():
             if f.ip != ip:
-                self.conn.sendto(b'\xFF\x21' + struct.pack("h", p_id), f.ip)
-        self.conn.sendto(b'\xFF\xF1', ip)
-        self.clients.pop(ip)
-
-    def generate_new_id(self):
-        """Generates a new unique ID for the player"""
-        while 1:
-            p_id = random.randint(0, 1000)
-            for f in self.clients.values():
-                if p_id == f.id:
-                    continue
-            break
-        return p_id
-
-    def generate_new_color(self):
-        """Generates a new unique color for the player"""
-        while 1:
-            new_color = random.randint(0, len(colors)-1)
-            for f in self.clients.values():
-                if new_color == f.color_idx:
-                    continue
-            break
-        return new_color
+                self.send(left, f.ip)
+        if not timed_out:
+            self.send(protocol.LeaveAck.pack(), ip)
+        c = self.clients.remove(ip)
+        self.metrics.remove_client(ip)
+        if self.grid is not None:
+            self.grid.remove(p_id)
+        self.ids.release(c.id)
+        self.color_ids.release(c.color_idx)
+
+    def quantize(self, pos: tuple) -> tuple:
+        """Snaps a position to the `pos_quantize` grid, so sub-grid jitter doesn't count as movement"""
+        return quantize_pos(pos, self.pos_quantize)
+
+    def encode_snapshot(self, seq: int, server_ms: int, keyframe: bool, count: int,
+                        body: bytes, mtu: typing.Optional[int] = None) -> typing.List[bytes]:
+        """
+        Encodes a sequenced snapshot taken at `server_ms`, from `count` packed entries (see `PlayerStore.pack`).
+
+        If it fits in `mtu` (`snapshot_mtu` by default) this is a single 0x11 packet, otherwise it's split into 0x12
+        fragments
+        """
+        mtu = mtu or self.snapshot_mtu
+        flags = protocol.KEYFRAME if keyframe else 0x00
+        # Packing the header and adding the entries to it in a single concatenation measured the fastest, see
+        # `bench_protocol.py`
+        if protocol.Snapshot.size(count) <= mtu:
+            return [protocol.Snapshot.pack(seq, server_ms, flags, count) + body]
+
+        entry_size = protocol.entry_codec.size
+        per_frag = (mtu - protocol.SnapshotFragment.codec.size) // entry_size
+        frag_count = -(-count // per_frag)
+        if frag_count > 255:
+            raise ValueError(f"Snapshot of {count} players doesn't fit in 255 fragments")
+        body = memoryview(body)
+        packets = []
+        for frag_idx in range(frag_count):
+            chunk = body[frag_idx * per_frag * entry_size:(frag_idx + 1) * per_frag * entry_size]
+            n = len(chunk) // entry_size
+            packets.append(protocol.SnapshotFragment.pack(seq, server_ms, flags, frag_idx, frag_count, n) + chunk)
+        return packets
+
+    def pack_world(self) -> bytes:
+        """Packs the quantized snapshot entries of every player in the world"""
+        return self.clients.pack_all(self.pos_quantize)
+
+    def world_state(self) -> typing.Dict[int, tuple]:
+        """The quantized position of every player in the world the snapshots are built from, by id"""
+        return self.clients.positions(self.pos_quantize)
 
     def update_clients(self):
-        data = bytearray([0xFF, 0x10, len(self.clients)])
+        if not self.delta_snapshots:
+            data = bytearray(protocol.World.pack(len(self.clients)))
+            data += self.clients.pack_all()
+
+            for c in self.clients.values():
+                self.send(data, c.ip)
+            return
+
+        seq = self.snap_seq
+        self.snap_seq = (seq + 1) & 0xFFFF
+        server_ms = int((self.clock() - self.started) * 1000) & 0xFFFFFFFF
+        state = self.world_state()
+
+        # Without an area of interest, clients that are at the same known state (and packet size) get the same
+        # packets, so only build each one once
+        packets = {}
         for c in self.clients.values():
-            data += struct.pack("hhh", c.id, c.pos[0], c.pos[1])
+            c.known.pop((seq - self.snapshot_history) & 0xFFFF, None)
+            c.sent.pop((seq - self.snapshot_history) & 0xFFFF, None)
+            if self.congestion_control and not c.link.due():
+                # Not this client's turn, at the rate its link can take
+                continue
+            mtu = c.link.mtu if self.congestion_control else self.snapshot_mtu
+            if self.aoi_radius is None:
+                visible = state
+            else:
+                visible = {p_id: state[p_id] for p_id in self.grid.query(c.pos, self.aoi_radius)}
+            base = None
+            unacked = []
+            # Counted per client, as a client that doesn't get every tick's snapshot could always miss the same ones
+            keyframe = c.last_keyframe is None or ((seq - c.last_keyframe) & 0xFFFF) >= self.keyframe_interval
+            if not keyframe and c.acked_seq is not None:
+                base = c.known.get(c.acked_seq)
+            if base is not None:
+                # The client applied the acknowledged snapshot, but may or may not have gotten the ones sent since,
+                # so each player they carried could be at either position on its side
+                unacked = list(c.sent.values())
+                if self.aoi_radius is not None and any(not s.keys() <= visible.keys() for s in [base] + unacked):
+                    # Someone the client might know about went out of its area. A delta has no way to say so, but
+                    # the client hides the players a keyframe doesn't have
+                    base = None
+                    unacked = []
+            key = (id(base) if base is not None else None, mtu, tuple(id(sent) for sent in unacked))
+            if self.aoi_radius is not None or key not in packets:
+                if base is None:
+                    if self.aoi_radius is None:
+                        body = self.pack_world()
+                    else:
+                        body = self.clients.pack(list(visible.items()))
+                    packets[key] = (self.encode_snapshot(seq, server_ms, True, len(visible), body, mtu),
+                                     visible, visible)
+                else:
+                    # The players that moved since the base, and anyone an unacknowledged snapshot had somewhere
+                    # else than where they are now (even if they are back at their base position), as the client
+                    # might have applied that snapshot. Both are set operations on the items, which run in C
+                    # instead of comparing player by player
+                    changed = dict(visible.items() - base.items())
+                    for sent in unacked:
+                        for p_id, pos in sent.items() - visible.items():
+                            if p_id in visible:
+                                changed[p_id] = visible[p_id]
+                    known = base
+                    if changed:
+                        known = dict(base)
+                        known.update(changed)
+                    # Even if no one moved, the (empty) snapshot still tells the client the time it's up to, so
+                    # it knows the players stopped instead of guessing where they went
+                    body = self.clients.pack(list(changed.items()))
+                    packets[key] = (self.encode_snapshot(seq, server_ms, False, len(changed), body, mtu),
+                                    known, changed)
+            data, known, sent = packets[key]
+            if base is None:
+                c.last_keyframe = seq
+            c.known[seq] = known
+            c.sent[seq] = sent
+            for d in data:
+                self.send(d, c.ip)
+
+    def reap_clients(self):
+        """Drops the clients that went silent for `client_timeout` seconds, i.e that crashed without a 0xF0"""
+        now = self.clock()
+        if self.client_timeout is None or now - self.last_reap < self.reap_interval:
+            return
+        self.last_reap = now
+        for ip in [c.ip for c in self.clients.values() if now - c.last_seen > self.client_timeout]:
+            self.remove_player(ip, timed_out=True)
 
+    def ping_clients(self):
+        """Pings the clients that are due for one, and counts the pings that never came back as lost"""
+        if not self.congestion_control:
+            return
+        now = self.clock()
         for c in self.clients.values():
-            self.conn.sendto(data, c.ip)
+            c.link.expire(now)
+            seq = c.link.next_ping(now, self.ping_interval)
+            if seq is not None:
+                self.send(protocol.Ping.pack(seq), c.ip)
+
+    def tick(self):
+        """Runs one server tick"""
+        self.reap_clients()
+        self.ping_clients()
+        self.update_clients()
+
+    def report_ticks(self):
+        """Logs the tick timing stats every `tick_report_interval` seconds"""
+        now = self.clock()
+        if now - self.last_tick_report >= self.tick_report_interval:
+            self.last_tick_report = now
+            self.log.info(f"Ticks at {self.tick_rate}Hz: {self.ticker.reset_stats()}")
+
+    def notify_shutdown(self):
+        """Tells every client that the server is going away"""
+        for c in self.clients.values():
+            self.send(protocol.Shutdown.pack(), c.ip)
+
+
+class ServerHandler(GameServer):
+    """
+    The threaded engine: a thread blocks on `recvfrom` and handles packets, while the main loop ticks
+    `update_clients`. Both share the player table through `client_lock`.
+    """
+    def __init__(self):
+        super().__init__()
+        self.conn = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.conn.settimeout(2)
+        self.t = threading.Thread(target=self.run_thread)
+        self.client_lock = threading.Lock()
+
+    def transmit(self, data: bytes, ip: tuple):
+        self.conn.sendto(data, ip)
+
+    def locked_tick(self):
+        with self.client_lock:
+            self.tick()
+        self.report_ticks()
+
+    def run(self):
+        self.conn.bind(self.addr)
+        self.t.start()
+        try:
+            self.ticker.run(self.locked_tick, lambda: self.exit)
+        except KeyboardInterrupt:
+            pass
+
+    def run_thread(self):
+        while not self.exit:
+            try:
+                r, r_from = self.conn.recvfrom(1024)
+                self.log.debug("Recv %s from %s", r, r_from)
+            except socket.timeout:
+                continue
+            if self.metrics.enabled:
+                start = time.perf_counter()
+                with self.client_lock:
+                    self.metrics.on_lock_wait(time.perf_counter() - start)
+                    self.handle_packet(r, r_from)
+            else:
+                with self.client_lock:
+                    self.handle_packet(r, r_from)
 
     def __exit__(self):
         self.close()
 
     def close(self):
         print("Closing socket")
-        for c in self.clients.values():
-            self.conn.sendto(b"\xFF\xE0", c.ip)
+        self.notify_shutdown()
         self.exit = True
         self.t.join()
         self.conn.close()
 
 
-logging.basicConfig(level=logging.DEBUG)
-srv = ServerHandler()
-srv.run()
+class AsyncServerHandler(GameServer, asyncio.DatagramProtocol):
+    """
+    The asyncio engine: packets are handled as they come in by the event loop, and the tick loop is a coroutine
+    running on that same loop. As only one of them runs at a time, no lock is needed.
+    """
+    reuse_port = False          # set SO_REUSEPORT on the socket, so that multiple processes can bind the same port
+    def __init__(self):
+        super().__init__()
+        self.transport = None       # type: typing.Optional[asyncio.DatagramTransport]
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: tuple):
+        self.log.debug("Recv %s from %s", data, addr)
+        self.handle_packet(data, addr)
+
+    def transmit(self, data: bytes, ip: tuple):
+        self.transport.sendto(data, ip)
+
+    def tick(self):
+        super().tick()
+        self.report_ticks()
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=self.addr, reuse_port=self.reuse_port or None)
+        try:
+            await self.ticker.run_async(self.tick, lambda: self.exit)
+        finally:
+            self.close()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+    def close(self):
+        if self.transport is None or self.transport.is_closing():
+            return
+        print("Closing socket")
+        self.notify_shutdown()
+        self.exit = True
+        self.transport.close()
+
+
+engines = {'thread': ServerHandler, 'asyncio': AsyncServerHandler}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Multiplayer game server example")
+    parser.add_argument('--engine', choices=engines.keys(), default='thread',
+                        help="how the server handles the socket and the tick loop")
+    parser.add_argument('--port', type=int, default=GameServer.addr[1], help="the UDP port to listen on")
+    parser.add_argument('--tick-rate', type=float, default=GameServer.tick_rate, help="server ticks per second")
+    parser.add_argument('--tick-policy', choices=[TickScheduler.SKIP, TickScheduler.CATCH_UP],
+                        default=GameServer.tick_policy, help="what to do with ticks the server was too late for")
+    parser.add_argument('--client-timeout', type=float, default=GameServer.client_timeout,
+                        help="drop clients that didn't send anything for this many seconds, 0 to never")
+    parser.add_argument('--min-send-rate', type=float, default=GameServer.min_send_rate,
+                        help="the fewest snapshots a second a client with a bad link gets")
+    parser.add_argument('--no-congestion-control', action='store_true',
+                        help="send every client a snapshot every tick, whatever its link")
+    parser.add_argument('--stats-port', type=int, help="answer any datagram on this local UDP port with the metrics")
+    parser.add_argument('--stats-file', help="periodically write the metrics as JSON to this file")
+    parser.add_argument('--stats-interval', type=float, default=5.0, help="how often the metrics file is written")
+    parser.add_argument('--capture', help="record every received datagram to this file, for `replay.py`")
+    parser.add_argument('-v', '--verbose', action='store_true', help="log every packet")
+    parser.add_argument('--aoi-radius', type=int, default=GameServer.aoi_radius,
+                        help="only send each client the players within this many pixels of it")
+    parser.add_argument('--store', choices=['dict', 'numpy'], default='dict',
+                        help="how the player table is stored, `numpy` needs NumPy installed")
+    args = parser.parse_args()
+
+    GameServer.addr = (GameServer.addr[0], args.port)
+    GameServer.tick_rate = args.tick_rate
+    GameServer.tick_policy = args.tick_policy
+    GameServer.client_timeout = args.client_timeout or None
+    GameServer.min_send_rate = args.min_send_rate
+    GameServer.congestion_control = not args.no_congestion_control
+    GameServer.aoi_radius = args.aoi_radius
+    if args.store == 'numpy':
+        from numpy_store import ArrayPlayerStore
+        GameServer.store = ArrayPlayerStore
+
+    GameServer.metrics_enabled = args.stats_port is not None or args.stats_file is not None
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    srv = engines[args.engine]()
+    if args.capture:
+        from capture import CaptureWriter
+        srv.capture = CaptureWriter(args.capture)
+    reporter = None
+    if srv.metrics.enabled:
+        reporter = StatsReporter(srv.metrics, args.stats_port, args.stats_file, args.stats_interval)
+        reporter.start()
+    srv.run()
 
-srv.close()
+    srv.close()
+    if reporter is not None:
+        reporter.close()
+    if srv.capture is not None:
+        srv.capture.close()
@@ -0,0 +1,218 @@
+"""
+Sharded Multiplayer Game Server
+By Jamal Bouajjaj, 2023
+
+Runs multiple server worker processes on the same port with SO_REUSEPORT. The kernel hashes each client's address
+to one of the workers, so every client always talks to the same worker, which owns that player. The workers then
+share their players' positions through shared memory, so that everyone still sees everyone.
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import argparse
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import struct
+import typing
+from multiprocessing import shared_memory
+
+import protocol
+from server import AsyncServerHandler
+from allocator import IdAllocator
+
+
+class ShardTable:
+    """
+    The table of players shared between all the shards.
+
+    Each shard has its own region that only it writes to, made of a header `(seq, count)` followed by `count`
+    entries of `(id, color, x pos, y pos)`. The `seq` acts as a seqlock: it is odd while the shard is writing, so
+    readers retry until they get a region that wasn't changed under them. A shard that died while writing leaves it
+    odd forever, so after `max_retries` the reader settles for the last copy it got.
+    """
+    header = struct.Struct("=II")
+    entry = struct.Struct("=hhhh")
+    max_retries = 10000
+
+    def __init__(self, buf: memoryview, n_shards: int, slots: int):
+        self.buf = buf
+        self.n_shards = n_shards
+        self.slots = slots
+        self.region_size = self.region_bytes(slots)
+        self.last_good = {}     # type: typing.Dict[int, typing.List[tuple]]
+
+    @classmethod
+    def region_bytes(cls, slots: int) -> int:
+        return cls.header.size + cls.entry.size * slots
+
+    @classmethod
+    def size(cls, n_shards: int, slots: int) -> int:
+        """The amount of shared memory needed for the table"""
+        return cls.region_bytes(slots) * n_shards
+
+    def publish(self, shard: int, entries: typing.List[tuple]):
+        """Writes a shard's players, as (id, color, x, y) entries, into its region"""
+        base = shard * self.region_size
+        seq, _ = self.header.unpack_from(self.buf, base)
+        entries = entries[:self.slots]
+        self.header.pack_into(self.buf, base, (seq + 1) & 0xFFFFFFFF, len(entries))
+        offset = base + self.header.size
+        for e in entries:
+            self.entry.pack_into(self.buf, offset, *e)
+            offset += self.entry.size
+        self.header.pack_into(self.buf, base, (seq + 2) & 0xFFFFFFFF, len(entries))
+
+    def clear(self, shard: int):
+        """Empties a shard's region, for when its worker is gone. Only safe once nothing writes to it anymore"""
+        base = shard * self.region_size
+        seq, _ = self.header.unpack_from(self.buf, base)
+        # Back to even, in case it died in the middle of a `publish`
+        self.header.pack_into(self.buf, base, ((seq | 1) + 1) & 0xFFFFFFFF, 0)
+
+    def read(self, shard: int) -> typing.List[tuple]:
+        """Reads a consistent copy of a shard's players, as (id, color, x, y) entries"""
+        base = shard * self.region_size
+        for _ in range(self.max_retries):
+            seq, count = self.header.unpack_from(self.buf, base)
+            if seq & 1:
+                continue
+            data = bytes(self.buf[base + self.header.size:base + self.header.size + count * self.entry.size])
+            if self.header.unpack_from(self.buf, base)[0] == seq:
+                entries = list(self.entry.iter_unpack(data))
+                self.last_good[shard] = entries
+                return entries
+        return self.last_good.get(shard, [])
+
+
+class ShardWorker(AsyncServerHandler):
+    """
+    One worker of the sharded server. It's a normal asyncio server for the players that connect to it, that also
+    publishes them to the shared table every tick, and mirrors the players of the other shards.
+
+    Player ids are unique across shards by only giving out ids where `id % n_shards == index`.
+    Colors are allocated per shard, so they are only unique within one.
+    `max_players` is per worker.
+    """
+    reuse_port = True
+
+    def __init__(self, index: int, n_shards: int, shm_name: str):
+        super().__init__()
+        self.log = logging.getLogger(f'shard{index}')
+        self.index = index
+        self.n_shards = n_shards
+        self.shm = shared_memory.SharedMemory(name=shm_name)
+        self.table = ShardTable(self.shm.buf, n_shards, self.max_players)
+        # Only give out the ids that belong to this shard, so they are unique across all of them
+        self.ids = IdAllocator(index, 0x8000, n_shards)
+
+        self.remote = {}        # type: typing.Dict[int, tuple]
+
+    def add_player(self, ip: tuple):
+        super().add_player(ip)
+        if ip not in self.clients:
+            return
+        # Also tell the new player about the ones owned by the other shards
+        for p_id, (color, pos) in self.remote.items():
+            self.send(protocol.PlayerJoined.pack(p_id, color), ip)
+
+    def sync_shards(self):
+        """Publishes this shard's players, and mirrors the other shards' players into `remote`"""
+        self.table.publish(self.index, [(c.id, c.color_idx, c.pos[0], c.pos[1]) for c in self.clients.values()])
+
+        remote = {}
+        for shard in range(self.n_shards):
+            if shard == self.index:
+                continue
+            for p_id, color, x, y in self.table.read(shard):
+                remote[p_id] = (color, (x, y))
+
+        for p_id in self.remote.keys() - remote.keys():
+            if self.grid is not None:
+                self.grid.remove(p_id)
+            left = protocol.PlayerLeft.pack(p_id)
+            for c in self.clients.values():
+                self.send(left, c.ip)
+        for p_id, (color, pos) in remote.items():
+            if p_id not in self.remote:
+                if self.grid is not None:
+                    self.grid.insert(p_id, pos)
+                joined = protocol.PlayerJoined.pack(p_id, color)
+                for c in self.clients.values():
+                    self.send(joined, c.ip)
+            elif self.grid is not None:
+                self.grid.move(p_id, pos)
+        self.remote = remote
+
+    def update_clients(self):
+        self.sync_shards()
+        super().update_clients()
+
+    def world_state(self) -> typing.Dict[int, tuple]:
+        state = super().world_state()
+        for p_id, (color, pos) in self.remote.items():
+            state[p_id] = self.quantize(pos)
+        return state
+
+    def pack_world(self) -> bytes:
+        remote = [(p_id, self.quantize(pos)) for p_id, (color, pos) in self.remote.items()]
+        return super().pack_world() + self.clients.pack(remote)
+
+    def close(self):
+        super().close()
+        # Un-publish our players so the other shards drop them
+        self.table.publish(self.index, [])
+
+
+def run_worker(index: int, n_shards: int, shm_name: str, log_level: int):
+    logging.basicConfig(level=log_level)
+    srv = ShardWorker(index, n_shards, shm_name)
+    try:
+        srv.run()
+    finally:
+        srv.close()
+        srv.shm.close()
+
+
+def run_sharded(n_shards: int, log_level: int = logging.INFO):
+    """Starts `n_shards` worker processes and waits for them to finish"""
+    shm = shared_memory.SharedMemory(create=True, size=ShardTable.size(n_shards, ShardWorker.max_players))
+    shm.buf[:] = bytes(shm.size)
+    table = ShardTable(shm.buf, n_shards, ShardWorker.max_players)
+    log = logging.getLogger('shards')
+    workers = [multiprocessing.Process(target=run_worker, args=(i, n_shards, shm.name, log_level), name=f"shard{i}")
+               for i in range(n_shards)]
+    try:
+        for w in workers:
+            w.start()
+        running = set(range(n_shards))
+        while running:
+            multiprocessing.connection.wait([workers[i].sentinel for i in running])
+            for i in [i for i in running if not workers[i].is_alive()]:
+                # Whatever it published last would stay there, so the other shards would keep its players around
+                table.clear(i)
+                running.remove(i)
+                log.info(f"Worker {i} exited with {workers[i].exitcode}, cleared its players")
+    except KeyboardInterrupt:
+        # The workers get the interrupt as well, give them a chance to say goodbye to their clients
+        for w in workers:
+            w.join(5)
+    finally:
+        for w in workers:
+            if w.is_alive():
+                w.terminate()
+        shm.close()
+        shm.unlink()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sharded multiplayer game server example")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="the number of worker processes")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    run_sharded(args.workers)
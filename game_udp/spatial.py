@@ -0,0 +1,73 @@
+"""
+Spatial Index for the Multiplayer Game Server
+By Jamal Bouajjaj, 2023
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import typing
+
+
+class SpatialGrid:
+    """
+    A uniform grid over the game world, used to quickly find which players are near a position.
+
+    Each cell is `cell_size` pixels wide, and holds the keys of everything inside of it. With the cell size set to the
+    query radius, a query only has to look at the 3x3 cells around the position.
+    """
+    def __init__(self, cell_size: int):
+        self.cell_size = cell_size
+        self.cells = {}         # type: typing.Dict[tuple, typing.Set[typing.Hashable]]
+        self.items = {}         # type: typing.Dict[typing.Hashable, tuple]
+
+    def _cell(self, pos: tuple) -> tuple:
+        return int(pos[0]) // self.cell_size, int(pos[1]) // self.cell_size
+
+    def insert(self, key: typing.Hashable, pos: tuple):
+        """Adds a new key at a position, or moves it if it already exists"""
+        if key in self.items:
+            self.move(key, pos)
+            return
+        self.items[key] = pos
+        self.cells.setdefault(self._cell(pos), set()).add(key)
+
+    def move(self, key: typing.Hashable, pos: tuple):
+        """Updates the position of a key, only touching the cells if it crossed into another one"""
+        old_cell = self._cell(self.items[key])
+        new_cell = self._cell(pos)
+        self.items[key] = pos
+        if old_cell != new_cell:
+            self._discard(old_cell, key)
+            self.cells.setdefault(new_cell, set()).add(key)
+
+    def remove(self, key: typing.Hashable):
+        """Removes a key from the grid"""
+        pos = self.items.pop(key)
+        self._discard(self._cell(pos), key)
+
+    def _discard(self, cell: tuple, key: typing.Hashable):
+        s = self.cells[cell]
+        s.discard(key)
+        if not s:
+            self.cells.pop(cell)
+
+    def query(self, pos: tuple, radius: float) -> typing.Iterator[typing.Hashable]:
+        """Yields every key that is within `radius` of the position"""
+        r2 = radius * radius
+        reach = -(-int(radius) // self.cell_size)    # ceil, in cells
+        cx, cy = self._cell(pos)
+        for gx in range(cx - reach, cx + reach + 1):
+            for gy in range(cy - reach, cy + reach + 1):
+                cell = self.cells.get((gx, gy))
+                if cell is None:
+                    continue
+                for key in cell:
+                    kx, ky = self.items[key]
+                    if (kx - pos[0]) ** 2 + (ky - pos[1]) ** 2 <= r2:
+                        yield key
+
+    def __len__(self):
+        return len(self.items)
@@ -0,0 +1,74 @@
+"""
+Player Storage for the Multiplayer Game Server
+By Jamal Bouajjaj, 2023
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import typing
+
+from protocol import entry_codec
+
+
+pos_min, pos_max = -0x8000, 0x7FFF     # what fits in a snapshot entry's position
+
+
+def quantize_pos(pos: tuple, q: int) -> tuple:
+    """Snaps a position to a grid of `q` pixels, without going past what fits in a snapshot entry"""
+    x = (pos[0] + q // 2) // q * q
+    y = (pos[1] + q // 2) // q * q
+    return min(max(x, pos_min), pos_max), min(max(y, pos_min), pos_max)
+
+
+class PlayerStore:
+    """
+    The table of connected players, by their address.
+
+    This one keeps the `ClientObject`s in a dictionary, and packs the snapshot entries one at a time. See
+    `numpy_store.ArrayPlayerStore` for one that keeps the positions in arrays.
+    """
+    def __init__(self):
+        self.by_ip = {}         # type: typing.Dict[tuple, typing.Any]
+
+    def add(self, client):
+        """Adds a new player, given its `ClientObject`"""
+        self.by_ip[client.ip] = client
+
+    def remove(self, ip: tuple):
+        """Removes a player, returning its `ClientObject`"""
+        return self.by_ip.pop(ip)
+
+    def set_pos(self, ip: tuple, pos: tuple):
+        """Updates the position of a player"""
+        self.by_ip[ip].pos = pos
+
+    def __getitem__(self, ip: tuple):
+        return self.by_ip[ip]
+
+    def __contains__(self, ip: tuple) -> bool:
+        return ip in self.by_ip
+
+    def __len__(self):
+        return len(self.by_ip)
+
+    def get(self, ip: tuple, default=None):
+        return self.by_ip.get(ip, default)
+
+    def values(self):
+        return self.by_ip.values()
+
+    def positions(self, q: int = 1) -> typing.Dict[int, tuple]:
+        """Gets the position of every player by id, quantized to `q` pixels"""
+        return {c.id: quantize_pos(c.pos, q) for c in self.by_ip.values()}
+
+    def pack_all(self, q: int = 1) -> bytes:
+        """Packs the snapshot entries of every player, with the positions quantized to `q` pixels"""
+        return b''.join(entry_codec.pack(c.id, *quantize_pos(c.pos, q)) for c in self.by_ip.values())
+
+    @staticmethod
+    def pack(entries: typing.List[tuple]) -> bytes:
+        """Packs a list of (id, pos) into snapshot entries"""
+        return b''.join(entry_codec.pack(p_id, pos[0], pos[1]) for p_id, pos in entries)
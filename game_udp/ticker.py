@@ -0,0 +1,130 @@
+"""
+Fixed Timestep Tick Scheduler
+By Jamal Bouajjaj, 2023
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import asyncio
+import dataclasses
+import time
+import typing
+
+
+@dataclasses.dataclass
+class TickStats:
+    ticks: int = 0              # ticks that were run
+    missed: int = 0             # ticks that were skipped because we were too late for them
+    overruns: int = 0           # ticks whose work took longer than the tick period
+    work_total: float = 0.0     # seconds spent doing the work of the ticks
+    work_max: float = 0.0
+    late_total: float = 0.0     # seconds between when ticks were due and when they started
+    late_max: float = 0.0
+
+    def as_dict(self) -> dict:
+        d = dataclasses.asdict(self)
+        d['work_avg'] = self.work_total / self.ticks if self.ticks else 0.0
+        d['late_avg'] = self.late_total / self.ticks if self.ticks else 0.0
+        return d
+
+    def __str__(self):
+        d = self.as_dict()
+        return (f"{self.ticks} ticks, {self.missed} missed, {self.overruns} overruns, "
+                f"work avg {d['work_avg'] * 1000:.2f}ms max {self.work_max * 1000:.2f}ms, "
+                f"late avg {d['late_avg'] * 1000:.2f}ms max {self.late_max * 1000:.2f}ms")
+
+
+class TickScheduler:
+    """
+    Runs something at a fixed rate, i.e the server's `update_clients`.
+
+    The deadlines are kept on a fixed grid from when it started (start + n * period) instead of sleeping one period
+    after each tick, so the rate doesn't drift with the time the work and the sleeps take.
+
+    When it falls behind by more than a tick, the `policy` decides what happens:
+    - `CATCH_UP`: run the late ticks back to back (up to `max_catch_up` of them, the rest are dropped)
+    - `SKIP`: run a single tick and drop the others, staying aligned with the grid
+    Dropped ticks are counted as `missed` in the stats.
+
+    `on_work`, if set, gets called with how long each tick's work took.
+    """
+    CATCH_UP = 'catch-up'
+    SKIP = 'skip'
+
+    def __init__(self, rate: float = 60, policy: str = SKIP, max_catch_up: int = 5,
+                 clock: typing.Callable[[], float] = time.perf_counter):
+        if policy not in (self.CATCH_UP, self.SKIP):
+            raise ValueError(f"Unknown tick policy {policy}")
+        self.rate = rate
+        self.period = 1 / rate
+        self.policy = policy
+        self.max_catch_up = max_catch_up
+        self.clock = clock
+        self.next = None        # type: typing.Optional[float]
+        self.stats = TickStats()
+        self.on_work = None     # type: typing.Optional[typing.Callable[[float], None]]
+
+    def start(self):
+        """Starts the schedule, with the first tick due right away"""
+        self.next = self.clock()
+
+    def delay(self) -> float:
+        """The time until the next tick is due, in seconds"""
+        if self.next is None:
+            self.start()
+        return max(0.0, self.next - self.clock())
+
+    def due(self) -> int:
+        """Returns how many ticks should be run now, and moves the schedule forward past them"""
+        if self.next is None:
+            self.start()
+        now = self.clock()
+        if now < self.next:
+            return 0
+        late = now - self.next
+        behind = int(late // self.period) + 1
+        if self.policy == self.SKIP:
+            run = 1
+        else:
+            run = min(behind, self.max_catch_up)
+        self.next += behind * self.period
+
+        self.stats.missed += behind - run
+        self.stats.late_total += late
+        self.stats.late_max = max(self.stats.late_max, late)
+        return run
+
+    def tick(self, fn: typing.Callable[[], None]):
+        """Runs one tick of work, timing it"""
+        start = self.clock()
+        fn()
+        work = self.clock() - start
+        self.stats.ticks += 1
+        self.stats.work_total += work
+        self.stats.work_max = max(self.stats.work_max, work)
+        if work > self.period:
+            self.stats.overruns += 1
+        if self.on_work is not None:
+            self.on_work(work)
+
+    def reset_stats(self) -> TickStats:
+        """Returns the stats so far, and starts counting from zero again"""
+        stats, self.stats = self.stats, TickStats()
+        return stats
+
+    def run(self, fn: typing.Callable[[], None], stop: typing.Callable[[], bool]):
+        """Runs `fn` every tick until `stop` returns True, sleeping in between"""
+        while not stop():
+            time.sleep(self.delay())
+            for _ in range(self.due()):
+                self.tick(fn)
+
+    async def run_async(self, fn: typing.Callable[[], None], stop: typing.Callable[[], bool]):
+        """Same as `run`, but sleeps with asyncio so the event loop keeps going in between the ticks"""
+        while not stop():
+            await asyncio.sleep(self.delay())
+            for _ in range(self.due()):
+                self.tick(fn)
@@ -2,69 +2,571 @@
 Telnet and TCP Server Example
 By Jamal Bouajjaj, 2023
 
+Serves many telnet sessions at once from a single thread: instead of blocking on one connection, every socket is
+non-blocking and a `selectors` selector tells us which ones are ready to be read from or written to.
+
+Nothing sleeps either: timed output (like `dance`) gets scheduled on a heap of timers, and the loop sends each
+piece once it's due while it keeps serving everyone else. Pieces of a session that are due at the same time go out
+together, in one send.
+
+Commands are registered by name with the `command` decorator, and the server keeps how often each one ran, how much
+it sent and how long it took to handle, which the `stats` command shows (only to `admin_hosts`).
+
+The responses that never change are built once, when the server starts. What a client can't take right away is
+queued as views of those buffers rather than copies, and once `write_buffer` bytes are queued for a client we stop
+running its commands until it read some of them.
+
+So that a few misbehaving clients can't take the server down, every second (`sweep_interval`) the server drops the
+sessions that:
+- didn't run a command for `idle_timeout` seconds
+- left a line unfinished for `read_timeout` seconds
+- didn't read anything of what we're trying to send them for `write_timeout` seconds
+Anyone that has over `max_write_buffer` bytes waiting gets dropped right away, and there can only be
+`max_sessions` sessions at once, `max_sessions_per_ip` of them from the same address.
+
 This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
 either version 3 of the License, or (at your option) any later version.
 This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
 See the GNU General Public License for more details.
 You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
 """
+import argparse
+import collections
+import errno
+import heapq
+import inspect
+import itertools
+import selectors
 import socket
 import time
+import types
+import typing
 
-addr = ("127.0.0.1", 8081)  # loopback (localhost), port 8080
+addr = ("127.0.0.1", 8081)  # loopback (localhost), port 8081
+max_line = 4096             # longest line we accept, so a client can't make us buffer forever
+admin_hosts = ("127.0.0.1",)    # who can run the admin commands
+write_buffer = 64 * 1024    # bytes queued for a client after which we wait for it to read them before going on
 
-def send_slow(conn, text):
-    """ Function to slowly send out a text over a socket"""
+# The responses, built once
+prompt = b"> "
+reset_screen = b'\033[0m\033[2J\033[1;1H'
+reset_color = b'\033[0m'
+help_text = "Welcome to [[APPLICATION GOOD!]], would you like to [[CONSUME NUTRIENTS!]]\n".encode()
+pong = b'\033[1mpong!\033[0m\n'
+dance_text = tuple(bytes([t]) for t in b"DANCING!!!")
+dance_frames = tuple(f'\033[{i:d}m\033[2J'.encode() for i in range(40, 48))
+python_payload = b'\xab\xcd\xef'*1000 + b'\n'
+colored = b'\033[91m\033[1mCOLORED BABY!!!\033[2m\033[36m\n'
+
+
+def send_slow(session, text):
+    """ Function to slowly send out a text over a socket, use with `yield from`"""
     for t in text:
-        conn.send(bytes([t]))
-        time.sleep(0.1)
-
-
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-    # Set this so that we can re-use the same address without waiting for TIME_WAIT
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    # We bind to the address we want
-    s.bind(addr)
-    # We start listening for connections
-    s.listen()
-    # We accept one connection with a client
-    conn, addr = s.accept()
-    with conn:
-        print(f"Connected by {addr}")
-        conn.send(f"Welcome to Jamal's GREAT application!\n".encode())
-        conn.send(f"You're name is {addr}, and you can drown yourself in the digital lake!\n".encode())
-        f = conn.makefile()     # Convinent so we can use `readline` without doing it ourselves
-        while True:
-            conn.sendall(b"> ")        # disable for python!
-            l = f.readline()
-            if l == '':
+        session.write(t)
+        yield 0.1
+
+
+@types.coroutine
+def pause(seconds: float):
+    """ Waits `seconds` before sending what's written next, for `async def` commands: `await pause(0.1)`"""
+    yield seconds
+
+
+class Command:
+    """
+    A command, and how it has been doing.
+
+    The handler gets called with the session. It can also be a generator, for a command that plays out over time:
+    every number it yields is how many seconds to wait before sending what it writes next. An `async def` handler
+    does the same with `await pause(...)`. Both are run through right away, the pauses only space out the writes, so
+    they can't await anything else
+    """
+    window = 1000           # how many of the latest handling times the percentiles are taken from
+
+    def __init__(self, name: str, handler, prompt: bool = True, admin: bool = False):
+        self.name = name
+        self.handler = handler
+        self.prompt = prompt        # if we send the prompt after it
+        self.admin = admin          # if only `admin_hosts` can run it
+        self.count = 0
+        self.bytes_sent = 0
+        self.times = collections.deque(maxlen=self.window)
+
+    def run(self, session):
+        start = time.perf_counter()
+        written = session.written
+        steps = self.handler(session)
+        if inspect.isgenerator(steps):
+            for seconds in steps:
+                session.wait(seconds)
+        elif inspect.iscoroutine(steps):
+            try:
+                while True:
+                    seconds = steps.send(None)
+                    if not isinstance(seconds, (int, float)):
+                        steps.close()
+                        raise TypeError(f"The {self.name} command awaited {seconds!r}, commands can only await pause()")
+                    session.wait(seconds)
+            except StopIteration:
+                pass
+        if self.prompt:
+            session.write(prompt)
+        self.count += 1
+        self.bytes_sent += session.written - written
+        self.times.append(time.perf_counter() - start)
+
+    def percentile(self, p: float) -> float:
+        """The handling time (in seconds) under which `p` percent of the latest ones are"""
+        if not self.times:
+            return 0.0
+        ordered = sorted(self.times)
+        return ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)]
+
+
+commands = {}   # type: typing.Dict[str, Command]
+
+
+def command(name: str, prompt: bool = True, admin: bool = False):
+    """Decorator that registers the function as the handler of the `name` command"""
+    def register(handler):
+        commands[name] = Command(name, handler, prompt, admin)
+        return handler
+    return register
+
+
+@command('help')
+def help_command(session):
+    session.write(help_text)
+
+
+@command('quit', prompt=False)
+def quit_command(session):
+    session.write("Closing!\n".encode())
+    session.finish()
+
+
+@command('ping')
+def ping(session):
+    session.write(pong)
+
+
+@command('dance')
+def dance(session):
+    yield from send_slow(session, dance_text)
+    for frame in dance_frames:
+        session.write(frame)
+        yield 0.25
+    session.write(reset_screen)
+
+
+@command('python')
+def python(session):
+    session.write(python_payload)
+
+
+@command('clear')
+def clear(session):
+    session.write(reset_screen)
+
+
+@command('colorme')
+def colorme(session):
+    session.write(colored)
+
+
+@command('stats', admin=True)
+def stats(session):
+    session.write(f"{'command':<12}{'count':>8}{'bytes':>12}{'p50 ms':>10}{'p99 ms':>10}\n".encode())
+    for cmd in list(commands.values()) + [unknown_command]:
+        session.write(f"{cmd.name:<12}{cmd.count:>8}{cmd.bytes_sent:>12}"
+                      f"{cmd.percentile(50) * 1e3:>10.3f}{cmd.percentile(99) * 1e3:>10.3f}\n".encode())
+
+
+# What runs for anything that isn't a command, it isn't registered so it can't be called by name
+unknown_command = Command('(unknown)', lambda session: session.write(b"Wrong command!\n"))
+
+
+class Session:
+    """
+    One connected client. What it sends is split into lines, each one being a command, and what we send back goes
+    through `write`, which keeps whatever the socket can't take right away until it's writable again. Once
+    `write_buffer` bytes are waiting, we stop reading and running their commands until it went back under.
+
+    Timed output is written after a `wait`: anything written after it gets scheduled to go out once the wait is
+    over. While some of it is still waiting, we stop reading from the client, so their next commands still run
+    after it's done.
+    """
+    def __init__(self, server, conn: socket.socket, addr: tuple):
+        self.server = server
+        self.conn = conn
+        self.addr = addr
+        self.inbuf = bytearray()
+        self.outbuf = collections.deque()   # views of what's left to send, in order
+        self.pending = 0                    # how many bytes are in `outbuf`
+        self.closing = False        # once set, we close the connection as soon as everything was sent
+        self.scheduled = 0          # how many timed writes are still waiting
+        self.timeline = 0.0         # when the next timed write goes out
+        self.written = 0            # bytes written so far, sent or not
+        self.events = 0             # what the selector waits for on our socket
+        self.last_active = time.monotonic()     # when they last ran a command
+        # When the unfinished line at the end of `inbuf` started coming in
+        self.line_started = None    # type: typing.Optional[float]
+        self.last_progress = self.last_active   # when the socket last took some of `outbuf`
+
+    def start(self):
+        print(f"Connected by {self.addr}")
+        self.write(f"Welcome to Jamal's GREAT application!\n".encode())
+        self.write(f"You're name is {self.addr}, and you can drown yourself in the digital lake!\n".encode())
+        self.write(prompt)
+
+    def write(self, data: bytes):
+        """Sends data to the client, after any timed output that's still waiting"""
+        if self.conn is None:
+            return
+        self.written += len(data)
+        if not self.scheduled and self.timeline <= time.monotonic():
+            self.send(data)
+            return
+        self.scheduled += 1
+        self.server.call_at(self.timeline, self, data)
+        self.server.watch(self)
+
+    def wait(self, pause: float):
+        """Makes what's written next go out `pause` seconds after what was written before it"""
+        self.timeline = max(self.timeline, time.monotonic()) + pause
+
+    def on_timer(self, data: bytes, count: int):
+        """Called by the server with the `count` timed writes that are now due, merged together"""
+        self.scheduled -= count
+        self.send(data)
+        if self.conn is None or self.scheduled:
+            return
+        if self.closing:
+            if not self.outbuf:
+                self.close()
+            return
+        # Back to the commands that came in meanwhile
+        self.server.watch(self)
+        self.process_lines()
+
+    def send(self, data: bytes):
+        """
+        Sends data to the client right away, without ever blocking. What the socket didn't take is queued without
+        copying it, so the data can't be changed afterwards
+        """
+        if self.conn is None:
+            return
+        n = 0
+        if not self.outbuf:
+            # Nothing is waiting before it, so try to send it right away
+            try:
+                n = self.conn.send(data)
+            except BlockingIOError:
+                pass
+            except OSError:
+                self.close()
+                return
+        if n < len(data):
+            if not self.outbuf:
+                self.last_progress = time.monotonic()
+            view = memoryview(data)[n:]
+            self.outbuf.append(view)
+            self.pending += len(view)
+            if self.pending > self.server.max_write_buffer:
+                print(f"Dropping {self.addr}, over {self.server.max_write_buffer} bytes are waiting for them")
+                self.close()
+                return
+            self.server.watch(self)
+
+    def busy(self) -> bool:
+        """If we have to wait before running their next command"""
+        return self.scheduled > 0 or self.pending >= write_buffer
+
+    def on_readable(self):
+        try:
+            data = self.conn.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            # The client closed the connection
+            self.finish()
+            return
+        if self.closing:
+            # We are only waiting to send what's left, anything else they say doesn't matter
+            return
+        self.inbuf += data
+        self.process_lines()
+
+    def process_lines(self):
+        """Runs the commands that are in the input buffer, until one of them schedules some output"""
+        while self.conn is not None and not self.closing and not self.busy():
+            end = self.inbuf.find(b'\n')
+            if end == -1:
+                if len(self.inbuf) > max_line:
+                    self.write(b"Line too long!\n")
+                    self.finish()
+                elif self.inbuf and self.line_started is None:
+                    self.line_started = time.monotonic()
+                break
+            line = self.inbuf[:end].decode(errors='replace')
+            del self.inbuf[:end + 1]
+            self.line_started = None
+            self.last_active = time.monotonic()
+            self.handle_line(line.strip())
+
+    def on_writable(self):
+        was_busy = self.busy()
+        while self.outbuf:
+            view = self.outbuf[0]
+            try:
+                n = self.conn.send(view)
+            except BlockingIOError:
                 break
-            l = l.strip()
-            if l == 'help':
-                conn.sendall("Welcome to [[APPLICATION GOOD!]], would you like to [[CONSUME NUTRIENTS!]]\n".encode())
-            elif l == 'quit':
-                conn.sendall("Closing!\n".encode())
+            except OSError:
+                self.close()
+                return
+            self.pending -= n
+            if n:
+                self.last_progress = time.monotonic()
+            if n < len(view):
+                # The socket is full, keep the rest for the next time it's writable
+                self.outbuf[0] = view[n:]
                 break
-            elif l == 'ping':
-                conn.sendall(b'\033[1mpong!\033[0m\n')
-            elif l == 'dance':
-                send_slow(conn, b"DANCING!!!")
-                for i in range(40, 48):
-                    conn.sendall(f'\033[{i:d}m\033[2J'.encode())
-                    time.sleep(0.25)
-                conn.sendall(b'\033[0m\033[2J\033[1;1H')
-            elif l == 'python':
-                conn.sendall(b'\xab\xcd\xef'*1000)
-                conn.sendall(b'\n')
-            elif l == 'clear':
-                conn.sendall(b'\033[0m\033[2J\033[1;1H')
-            elif l == 'colorme':
-                conn.sendall(b'\033[91m\033[1mCOLORED BABY!!!\033[2m\033[36m\n')
+            self.outbuf.popleft()
+        if self.closing and not self.outbuf and not self.scheduled:
+            self.close()
+            return
+        self.server.watch(self)
+        if was_busy and not self.busy():
+            # They caught up, back to their commands
+            self.process_lines()
+
+    def check_timeouts(self, now: float):
+        """Drops the session if it went over any of the server's timeouts"""
+        if self.outbuf and now - self.last_progress > self.server.write_timeout:
+            # They aren't reading, so there's no point in saying goodbye
+            print(f"Dropping {self.addr}, they didn't read anything for {self.server.write_timeout}s")
+            self.close()
+        elif self.closing:
+            return
+        elif self.line_started is not None and now - self.line_started > self.server.read_timeout:
+            self.write(b"\nLine took too long!\n")
+            self.finish()
+        elif now - self.last_active > self.server.idle_timeout:
+            self.write(b"\nIdle for too long!\n")
+            self.finish()
+
+    def handle_line(self, l: str):
+        cmd = commands.get(l)
+        if cmd is None or (cmd.admin and self.addr[0] not in admin_hosts):
+            cmd = unknown_command
+        cmd.run(self)
+
+    def finish(self):
+        """Ends the session once what's left to send got sent"""
+        if self.closing:
+            return
+        self.write(reset_color)
+        self.closing = True
+        if not self.outbuf and not self.scheduled:
+            self.close()
+
+    def close(self):
+        if self.conn is None:
+            return
+        print(f"Disconnected {self.addr}")
+        self.server.forget(self)
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.conn.close()
+        self.conn = None
+
+
+class TelnetServer:
+    idle_timeout = 300.0
+    read_timeout = 30.0
+    write_timeout = 60.0
+    max_write_buffer = 1024 * 1024
+    max_sessions = 1000
+    max_sessions_per_ip = 16
+    sweep_interval = 1.0
+
+    def __init__(self, addr: tuple, backlog: int = 1024):
+        self.sel = selectors.DefaultSelector()
+        self.sessions = set()
+        self.per_ip = collections.Counter()
+        self.accepting = True
+        self.next_sweep = time.monotonic() + self.sweep_interval
+        # The timed writes, as (when, order, session, data). The order keeps the ones due at the same time in the
+        # order they were scheduled in, and keeps the sessions from ever being compared
+        self.timers = []
+        self.timer_order = itertools.count()
+        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Set this so that we can re-use the same address without waiting for TIME_WAIT
+        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # We bind to the address we want
+        self.s.bind(addr)
+        # We start listening for connections, with room for a lot of them waiting to be accepted
+        self.s.listen(backlog)
+        self.s.setblocking(False)
+        self.sel.register(self.s, selectors.EVENT_READ, None)
+
+    def accept(self):
+        # Accept everyone that's waiting, not just one per loop
+        while True:
+            try:
+                conn, addr = self.s.accept()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                print(f"Couldn't accept a connection: {e}")
+                if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    # Out of file descriptors (or memory). The connection stays waiting, so the listening socket
+                    # stays readable and waiting on it would only spin, stop accepting until the next sweep instead
+                    self.sel.unregister(self.s)
+                    self.accepting = False
+                    return
+                # i.e the client gave up before we got to it
+                continue
+            conn.setblocking(False)
+            if len(self.sessions) >= self.max_sessions or self.per_ip[addr[0]] >= self.max_sessions_per_ip:
+                try:
+                    conn.send(b"Too many connections, try again later!\n")
+                except OSError:
+                    pass
+                conn.close()
+                continue
+            session = Session(self, conn, addr)
+            self.sessions.add(session)
+            self.per_ip[addr[0]] += 1
+            self.watch(session)
+            session.start()
+
+    def watch(self, session: Session):
+        """
+        Updates what we wait for on a session's socket: writing if it has anything to send, and reading unless it's
+        `busy`
+        """
+        if session.conn is None or session not in self.sessions:
+            return
+        events = 0
+        if not session.busy():
+            events |= selectors.EVENT_READ
+        if session.outbuf:
+            events |= selectors.EVENT_WRITE
+        if events == session.events:
+            return
+        # The selector can't wait for nothing, so a session that waits for nothing gets taken out of it for now
+        if not session.events:
+            self.sel.register(session.conn, events, session)
+        elif not events:
+            self.sel.unregister(session.conn)
+        else:
+            self.sel.modify(session.conn, events, session)
+        session.events = events
+
+    def forget(self, session: Session):
+        if session in self.sessions:
+            self.sessions.remove(session)
+            self.per_ip[session.addr[0]] -= 1
+            if not self.per_ip[session.addr[0]]:
+                del self.per_ip[session.addr[0]]
+            if session.events:
+                self.sel.unregister(session.conn)
+                session.events = 0
+
+    def call_at(self, when: float, session: Session, data: bytes):
+        """Sends `data` to `session` once `time.monotonic()` gets to `when`"""
+        heapq.heappush(self.timers, (when, next(self.timer_order), session, data))
+
+    def run_timers(self):
+        """Sends out every timed write that's due, merging the ones of the same session into a single send"""
+        now = time.monotonic()
+        due = {}
+        while self.timers and self.timers[0][0] <= now:
+            _, _, session, data = heapq.heappop(self.timers)
+            if session.conn is None:
+                continue
+            if session in due:
+                due[session][0].extend(data)
+                due[session][1] += 1
             else:
-                conn.sendall(b"Wrong command!\n")
-            # data = conn.recv(1024)
-            # if not data:
-            #     break
-            # conn.sendall(f"-> {data}".encode())
-        conn.sendall(b'\033[0m')
-        conn.shutdown(socket.SHUT_RD)
+                due[session] = [bytearray(data), 1]
+        for session, (data, count) in due.items():
+            session.on_timer(data, count)
+
+    def sweep(self):
+        """Every `sweep_interval`, drops the sessions that went over a timeout, and goes back to accepting"""
+        now = time.monotonic()
+        if now < self.next_sweep:
+            return
+        self.next_sweep = now + self.sweep_interval
+        for session in list(self.sessions):
+            session.check_timeouts(now)
+        if not self.accepting:
+            self.sel.register(self.s, selectors.EVENT_READ, None)
+            self.accepting = True
+
+    def timeout(self) -> float:
+        """How long the selector can wait before the next timed write or sweep is due"""
+        when = self.next_sweep
+        if self.timers:
+            when = min(when, self.timers[0][0])
+        return max(0.0, when - time.monotonic())
+
+    def run(self):
+        while True:
+            for key, mask in self.sel.select(self.timeout()):
+                if key.data is None:
+                    self.accept()
+                    continue
+                session = key.data
+                if mask & selectors.EVENT_WRITE and session.conn is not None:
+                    session.on_writable()
+                if mask & selectors.EVENT_READ and session.conn is not None:
+                    session.on_readable()
+            self.run_timers()
+            self.sweep()
+
+    def close(self):
+        for session in list(self.sessions):
+            session.close()
+        self.sel.close()
+        self.s.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Telnet server example, serving many sessions at once")
+    parser.add_argument('--port', type=int, default=addr[1], help="the TCP port to listen on")
+    parser.add_argument('--idle-timeout', type=float, default=TelnetServer.idle_timeout,
+                        help="seconds without a command before a session gets dropped")
+    parser.add_argument('--read-timeout', type=float, default=TelnetServer.read_timeout,
+                        help="seconds a line can take to come in before the session gets dropped")
+    parser.add_argument('--write-timeout', type=float, default=TelnetServer.write_timeout,
+                        help="seconds a client can go without reading what we send before getting dropped")
+    parser.add_argument('--max-write-buffer', type=int, default=TelnetServer.max_write_buffer,
+                        help="bytes that can wait to be sent to a client before it gets dropped")
+    parser.add_argument('--max-sessions', type=int, default=TelnetServer.max_sessions,
+                        help="the most sessions at once")
+    parser.add_argument('--max-sessions-per-ip', type=int, default=TelnetServer.max_sessions_per_ip,
+                        help="the most sessions at once from the same address")
+    args = parser.parse_args()
+
+    TelnetServer.idle_timeout = args.idle_timeout
+    TelnetServer.read_timeout = args.read_timeout
+    TelnetServer.write_timeout = args.write_timeout
+    TelnetServer.max_write_buffer = args.max_write_buffer
+    TelnetServer.max_sessions = args.max_sessions
+    TelnetServer.max_sessions_per_ip = args.max_sessions_per_ip
+
+    server = TelnetServer((addr[0], args.port))
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()